@@ -0,0 +1,124 @@
+# framing_bench.py - throughput of the ew2vm receive framing for large EasyWorship streams
+# https://github.com/mikenor/ew2vm
+#
+# Feeds a multi-megabyte EW stream through the old copy-and-slice framing loop and
+# through EWFrameDecoder, in chunks of different sizes. By default the stream is
+# synthesized (long schedules, slide info bursts, slide images); pass --stream FILE
+# to use raw received EW bytes captured from a real session instead. Exits with
+# status 1 if the two framed different messages. Run from the repository root:
+#
+#     python bench/framing_bench.py [--stream FILE] [--image-size BYTES] [--chunk-sizes N [N ...]]
+
+
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+
+
+
+
+
+# ew receive stream shaped like a service: live data for long presentations, a burst of slide info for each, slide images
+def synthesize_stream(presentations, slides, image_size):
+    stream = bytearray()
+    for pres in range(presentations):
+        rawdata = struct.pack('<lqqqlq', 0, pres + 1, 1000 + pres, 1, slides, 0) + b''.join(struct.pack('<qq', (pres * 100000) + i, 1) for i in range(slides))
+        stream += ('{"action":"LiveData","requestrev":1,"size":' + str(len(rawdata)) + '}\r\n').encode('utf-8') + rawdata
+        for i in range(slides):
+            stream += json.dumps({'action': 'slideInfo', 'requestrev': 1, 'slide_rowid': (pres * 100000) + i, 'title': 'Verse ' + str(i), 'content': 'Line of lyrics for this slide\n' * 4}).encode('utf-8') + b'\r\n'
+        image = bytes(range(256)) * (image_size // 256)
+        stream += ('{"action":"slideImage","requestrev":1,"size":' + str(len(image)) + '}\r\n').encode('utf-8') + image
+        stream += b'{"action":"status","requestrev":1,"liverev":1,"imagehash":"abc","slide_rowid":1}\r\n'
+    return bytes(stream)
+
+
+
+
+
+
+# framing loop as it was before EWFrameDecoder, kept here for comparison
+def frame_legacy(chunks, procmsg):
+    received_data = b''
+    for chunk in chunks:
+        received_data += chunk
+        newjson_len = received_data.find(b'\r\n')
+        while newjson_len != -1:
+            extrabytes_len = 0
+            try:
+                newjson = json.loads(received_data[:newjson_len].decode('utf-8'))
+            except json.decoder.JSONDecodeError:
+                newjson = ''
+            else:
+                if newjson.get('action', '') in ['LiveData', 'ScheduleData', 'currentImage', 'slideImage']:
+                    extrabytes_len = int(newjson.get('size', 0))
+            if len(received_data) >= (newjson_len + 2 + extrabytes_len):
+                if newjson != '':
+                    procmsg(newjson, received_data[(newjson_len + 2):(newjson_len + 2 + extrabytes_len)])
+                received_data = received_data[(newjson_len + 2 + extrabytes_len):]
+                newjson_len = received_data.find(b'\r\n')
+            else:
+                newjson_len = -1
+
+
+def frame_decoder(chunks, procmsg):
+    decoder = ew2vm.EWFrameDecoder()
+    for chunk in chunks:
+        for jsondata, rawdata in decoder.feed(chunk):
+            procmsg(jsondata, rawdata)
+
+
+
+
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the ew2vm receive framing.')
+    arg_parser.add_argument('--stream', metavar='FILE', help='raw EW receive stream to feed instead of a synthesized one')
+    arg_parser.add_argument('--presentations', type=int, default=4, metavar='N', help='presentations in the synthesized stream (default 4)')
+    arg_parser.add_argument('--slides', type=int, default=500, metavar='N', help='slides per synthesized presentation (default 500)')
+    arg_parser.add_argument('--image-size', type=int, default=2 * 1024 * 1024, metavar='BYTES', help='size of each synthesized slide image (default 2 MiB)')
+    arg_parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[1460, 16384, 65536, 1048576], metavar='N', help='recv sizes to feed the stream in (default 1460 16384 65536 1048576)')
+    args = arg_parser.parse_args()
+
+    if args.stream:
+        with open(args.stream, 'rb') as stream_file:
+            stream = stream_file.read()
+    else:
+        stream = synthesize_stream(args.presentations, args.slides, args.image_size)
+    print('stream %.1f MiB' % (len(stream) / 1048576))
+
+    mismatched = False
+    for chunk_size in args.chunk_sizes:
+        chunks = [stream[i:(i + chunk_size)] for i in range(0, len(stream), chunk_size)]
+        results = []
+        for name, frame in (('legacy', frame_legacy), ('decoder', frame_decoder)):
+            counts = [0, 0]
+            def procmsg(jsondata, rawdata):
+                counts[0] += 1
+                counts[1] += len(rawdata)
+            start = time.perf_counter()
+            frame(chunks, procmsg)
+            elapsed = time.perf_counter() - start
+            results.append((name, elapsed, counts))
+        if results[0][2] != results[1][2]:
+            print('MISMATCH: legacy and decoder framed different messages ' + str(results[0][2]) + ' ' + str(results[1][2]))
+            mismatched = True
+        print('chunk %8d  ' % chunk_size + '  '.join('%s %8.3f s (%7.1f MiB/s)' % (name, elapsed, len(stream) / 1048576 / elapsed) for name, elapsed, counts in results) + '  %d messages' % results[1][2][0])
+
+    if mismatched:
+        sys.exit(1)
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
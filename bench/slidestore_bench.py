@@ -0,0 +1,103 @@
+# slidestore_bench.py - cost of loading a long presentation into ew2vm, slide table decoding and readiness checks
+# https://github.com/mikenor/ew2vm
+#
+# Compares the old dict-per-slide model (slide table unpacked one slide at a time,
+# every slide scanned on every message to see whether all have arrived) against
+# SlideStore, for presentations of thousands of slides such as a long scripture
+# reading. Also times Bridge.procmsg_ew end to end for LiveData followed by the
+# slideInfo of every slide. Run from the repository root:
+#
+#     python bench/slidestore_bench.py [--slides N [N ...]]
+
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+
+
+
+
+
+# LiveData payload of a presentation with the given number of slides
+def livedata(slide_count):
+    return struct.pack('<lqqqlq', 0, 1, 1000, 1, slide_count, 0) + b''.join(struct.pack('<qq', 100000 + i, 1) for i in range(slide_count))
+
+
+# slide model as it was before SlideStore, kept here for comparison: load, then mark every slide received, scanning all slides after each
+def load_legacy(rawdata):
+    unknownrawdata0, rev, pres_rowid, title_revision, pres_len, unknownrawdata5 = struct.unpack_from('<lqqqlq', rawdata, 0)
+    slides = {}
+    for i in range(pres_len):
+        slide_rowid, revision = struct.unpack('<qq', rawdata[(40 + (16 * i)):(40 + (16 * i) + 16)])
+        slide = {}
+        slide['id'] = i
+        slide['slide_rowid'] = slide_rowid
+        slide['revision'] = revision
+        slide['infoReceived'] = False
+        slide['infoRequested'] = False
+        slides[slide_rowid] = slide
+    for slide_rowid in list(slides):
+        slides[slide_rowid]['infoReceived'] = True
+        waiting_for_slideinfo = False
+        for other_rowid in slides:
+            if not slides[other_rowid].get('infoReceived', False):
+                waiting_for_slideinfo = True
+    return waiting_for_slideinfo
+
+
+def load_slidestore(rawdata):
+    slides = ew2vm.SlideStore(ew2vm.unpack_presentation(rawdata)[3])
+    for slide in list(slides.values()):
+        slides.mark_received(slide)
+        waiting_for_slideinfo = slides.pending() > 0
+    return waiting_for_slideinfo
+
+
+# whole bridge: LiveData, then slideInfo of each slide, as procmsg_ew sees them
+def load_bridge(rawdata, slide_count):
+    bridge = ew2vm.Bridge(ew2vm.parse_args(['--vm-input', '1', '--slide-cache-size', '0']))
+    bridge.procmsg_ew({'action': 'status', 'liverev': 1, 'imagehash': 'a', 'slide_rowid': 100000, 'requestrev': 1}, b'')
+    bridge.procmsg_ew({'action': 'LiveData', 'requestrev': 1, 'size': len(rawdata)}, memoryview(rawdata))
+    bridge.procmsg_ew({'action': 'slideInfo', 'slide_rowid': 0, 'title': 'Reading', 'requestrev': 1}, b'')
+    for i in range(slide_count):
+        bridge.procmsg_ew({'action': 'slideInfo', 'slide_rowid': 100000 + i, 'title': 'Verse ' + str(i), 'content': 'In the beginning was the Word', 'requestrev': 1}, b'')
+    return bridge.imagehash == 'a'
+
+
+
+
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmarks loading long presentations into ew2vm.')
+    arg_parser.add_argument('--slides', type=int, nargs='+', default=[100, 1000, 5000], metavar='N', help='presentation sizes to load (default 100 1000 5000)')
+    args = arg_parser.parse_args()
+
+    for slide_count in args.slides:
+        rawdata = livedata(slide_count)
+        legacy_elapsed, legacy_waiting = timed(load_legacy, rawdata)
+        store_elapsed, store_waiting = timed(load_slidestore, rawdata)
+        bridge_elapsed, bridge_ready = timed(load_bridge, rawdata, slide_count)
+        if legacy_waiting or store_waiting or not bridge_ready:
+            print('MISMATCH: presentation did not finish loading')
+        print('slides %6d   legacy %9.3f ms   slidestore %8.3f ms   bridge end to end %8.3f ms (%.1f us per slide)' % (slide_count, legacy_elapsed * 1000, store_elapsed * 1000, bridge_elapsed * 1000, bridge_elapsed * 1000000 / slide_count))
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# txqueue_bench.py - idle CPU and enqueue-to-send latency of the ew2vm transmit path
+# https://github.com/mikenor/ew2vm
+#
+# Compares the old 2 ms busy-poll transmit loop against the current wakeup-driven
+# send_vm(). Run from the repository root:
+#
+#     python bench/txqueue_bench.py [--idle SECONDS] [--messages N]
+
+
+import argparse
+import collections
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+
+
+
+
+
+# transmit loop as it was before the wakeup-driven queue, kept here for comparison
+def send_vm_polling(vm_socket, txqueue, running):
+    while running.is_set():
+        outboundbytes = b''
+        try:
+            while True:
+                outboundbytes += txqueue.popleft()
+        except IndexError:
+            if len(outboundbytes) < 1:
+                time.sleep(0.002)
+            else:
+                vm_socket.sendall(outboundbytes)
+
+
+
+
+
+
+# run one transmit implementation, measure cpu while idle and latency of individual messages
+def measure(name, start, enqueue, stop, idle_seconds, message_count):
+    tx_socket, rx_socket = socket.socketpair()
+    thread = start(tx_socket)
+
+    # idle cpu: nothing is queued, so any cpu burnt here is the transmit thread polling
+    cpu_start = time.process_time()
+    time.sleep(idle_seconds)
+    idle_cpu = (time.process_time() - cpu_start) / idle_seconds * 100
+
+    # latency: timestamp at enqueue, compare when the bytes come out the other end of the socket
+    latencies = []
+    for i in range(message_count):
+        message = ('FUNCTION SetText Input=1&SelectedIndex=0&Value=' + str(i) + '\r\n').encode('utf-8')
+        enqueued = time.perf_counter()
+        enqueue(message)
+        received = b''
+        while not received.endswith(b'\r\n'):
+            received += rx_socket.recv(4096)
+        latencies.append((time.perf_counter() - enqueued) * 1000)
+        # let the transmit thread go back to sleep so every message measures a wakeup
+        time.sleep(0.005)
+
+    stop()
+    tx_socket.close()
+    thread.join()
+    rx_socket.close()
+    latencies.sort()
+    print('%-10s idle cpu %6.2f%%   latency ms: mean %.3f  p50 %.3f  p99 %.3f  max %.3f' % (name, idle_cpu, statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], latencies[-1]))
+
+
+
+
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the ew2vm transmit path.')
+    arg_parser.add_argument('--idle', type=float, default=5, metavar='SECONDS', help='how long to measure idle cpu (default 5)')
+    arg_parser.add_argument('--messages', type=int, default=500, metavar='N', help='how many messages to time (default 500)')
+    args = arg_parser.parse_args()
+
+    # before: busy-poll on a deque
+    running = threading.Event()
+    polling_queue = collections.deque()
+    def start_polling(tx_socket):
+        running.set()
+        thread = threading.Thread(target=send_vm_polling, args=(tx_socket, polling_queue, running))
+        thread.start()
+        return thread
+    measure('polling', start_polling, polling_queue.append, running.clear, args.idle, args.messages)
+
+    # after: send_vm blocking on TxQueue
+    bridge = ew2vm.Bridge(ew2vm.parse_args(['--vm-input', '1']))
+    link = bridge.vm_links[0]
+    def start_wakeup(tx_socket):
+        link.connected = True
+        thread = threading.Thread(target=ew2vm.send_vm, args=(bridge, link, tx_socket))
+        thread.start()
+        return thread
+    def stop_wakeup():
+        link.connected = False
+        link.txqueue.close()
+    measure('wakeup', start_wakeup, link.txqueue.append, stop_wakeup, args.idle, args.messages)
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
@@ -23,180 +23,2206 @@
 
 
 import argparse
+import asyncio
+import base64
 try:
     import colorama
     colorama.init()
 except:
     pass
 import collections
+import contextvars
+import dns.asyncresolver
 import dns.resolver
+import http.server
 import json
+import os
+import random
 import re
+import selectors
 import socket
 import struct
+import sys
 import threading
 import time
 import urllib.parse
+import xml.etree.ElementTree
 
 
 
 
 
 
-content_sent = ''
-contentvisible = True
-contentvisible_pending = False
-credit = ''
-credit_sent = ''
-ew_connected = False
-ew_txqueue = collections.deque()
-imagehash = ''
-imagehash_pending = ''
-liverev = 0
-liverev_pending = -1
-pres_rowid = 0
-presentation_filter_re = None
-presentation_filtered = True
-requestrev = 0
-slide_rowid_pending = -1
-slides = {}
-title = ''
-vm_connected = False
-vm_txqueue = collections.deque()
+LOG_QUIET = 0
+LOG_INFO = 1
+LOG_WIRE = 2
+
+
+# console log: callers only queue entries, a background worker formats and writes them so a slow console never holds up the connections
+# entries go into a ring buffer, if the console can't keep up the oldest are dropped (and counted) instead of piling up
+# prefix (e.g. the name of the bridge) is per context, so tasks of each bridge in supervisor mode tag their own lines
+class Log:
+    levels = {'quiet': LOG_QUIET, 'info': LOG_INFO, 'wire': LOG_WIRE}
+    
+    def __init__(self, level=LOG_INFO, maxlen=10000):
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.entries = collections.deque(maxlen=maxlen)
+        self.level = level
+        self.prefix = contextvars.ContextVar('log_prefix', default='')
+        self.stopping = False
+        self.worker = None
+    
+    def start(self, level):
+        self.level = self.levels[level]
+        self.worker = threading.Thread(target=self.run, name='log_thread', daemon=True)
+        self.worker.start()
+    
+    # write whatever is still queued, then stop the worker
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.worker:
+            self.worker.join()
+            self.worker = None
+    
+    def queue(self, entry):
+        with self.condition:
+            if len(self.entries) == self.entries.maxlen:
+                self.dropped += 1
+            self.entries.append(entry)
+            self.condition.notify()
+    
+    # shown even when quiet
+    def warning(self, text):
+        self.queue((None, '91', self.prefix.get() + 'WARNING: ' + text))
+    
+    def info(self, text):
+        if self.level >= LOG_INFO:
+            self.queue((None, '91', self.prefix.get() + text))
+    
+    # raw bytes sent or received, formatted only by the worker
+    def wire(self, tag, colour, data):
+        if self.level >= LOG_WIRE:
+            self.queue((self.prefix.get() + tag, colour, data))
+    
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.entries or self.stopping)
+                entries = list(self.entries)
+                self.entries.clear()
+                dropped, self.dropped = self.dropped, 0
+                stopping = self.stopping
+            lines = []
+            if dropped:
+                lines.append('\33[91mWARNING: Console too slow, ' + str(dropped) + ' log lines dropped.\033[0m')
+            for tag, colour, text in entries:
+                if tag is None:
+                    lines.append('\33[' + colour + 'm' + text + '\033[0m')
+                else:
+                    lines.append(tag + ': \33[' + colour + 'm' + text.decode('utf-8', 'replace').encode('unicode_escape').decode('utf-8') + '\033[0m')
+            if lines:
+                try:
+                    sys.stdout.write('\n'.join(lines) + '\n')
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+            if stopping:
+                return
+
+
+log = Log()
+
+
+
+
+
+
+# outgoing message queue, wakes the waiting transmit thread (or coroutine, via waker) whenever a message is added
+class TxQueue:
+    def __init__(self):
+        self.batch = 0 # number of messages retrieved by the last popall
+        self.closed = False
+        self.condition = threading.Condition()
+        self.messages = collections.deque()
+        self.waker = None
+    
+    def __len__(self):
+        return len(self.messages)
+    
+    def append(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+        if self.waker:
+            self.waker()
+    
+    # wake the transmit thread so it notices the connection is going away
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+    
+    # discard leftover messages and accept new ones for a fresh connection
+    def reopen(self):
+        with self.condition:
+            self.closed = False
+            self.messages.clear()
+    
+    # block until messages are queued, the queue is closed or timeout expires, then retrieve queue until it's emptied
+    def popall(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages or self.closed, timeout)
+            outboundbytes = b''.join(self.messages)
+            self.batch = len(self.messages)
+            self.messages.clear()
+        return outboundbytes
+
+
+
+
+
+
+# outgoing message queue where a newer message replaces an unsent older one with the same key, so only the latest state is sent
+# optionally holds messages back so that at most one batch goes out per min_interval seconds
+class CoalescingTxQueue(TxQueue):
+    def __init__(self, min_interval=0):
+        super().__init__()
+        self.coalesced = 0
+        self.messages = collections.OrderedDict()
+        self.min_interval = min_interval
+        self.sent_stamp = None # stamp of the last batch retrieved by popall
+        self.sent_timestamp = 0
+        self.stamp = None
+        self.trailing = {} # key -> message that stays behind anything queued after it while queued under that key, e.g. showing text only once it is set
+    
+    # stamp is the time of whatever caused the message, kept for the batch it ends up in (newest wins)
+    def append(self, message, key=None, stamp=None):
+        with self.condition:
+            if stamp is not None:
+                self.stamp = stamp
+            if key is None:
+                # message that must always be sent
+                key = object()
+            elif key in self.messages:
+                # outdated message is replaced in its place, so it stays ahead of whatever was queued after it
+                self.coalesced += 1
+            self.messages[key] = message
+            for trailing_key, trailing_message in self.trailing.items():
+                if trailing_key != key and self.messages.get(trailing_key) == trailing_message:
+                    self.messages.move_to_end(trailing_key)
+            self.condition.notify()
+        if self.waker:
+            self.waker()
+    
+    def reopen(self):
+        with self.condition:
+            super().reopen()
+            self.stamp = None
+    
+    # seconds to wait before the next batch may be sent
+    def holdoff(self):
+        return max(0, self.sent_timestamp + self.min_interval - time.monotonic())
+    
+    def popall(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages or self.closed, timeout)
+            if self.messages and not self.closed and self.holdoff() > 0:
+                # let more updates pile up (and replace each other) until the interval is over
+                self.condition.wait_for(lambda: self.closed, self.holdoff())
+            outboundbytes = b''.join(self.messages.values())
+            self.batch = len(self.messages)
+            self.messages.clear()
+            self.sent_stamp = None
+            if outboundbytes:
+                self.sent_stamp, self.stamp = self.stamp, None
+                self.sent_timestamp = time.monotonic()
+        return outboundbytes
+
+
+
+
+
+
+# incremental framing of the ew receive stream: each message is a JSON header line, some followed by `size` bytes of binary payload
+class EWFrameDecoder:
+    binary_actions = ('LiveData', 'ScheduleData', 'currentImage', 'slideImage')
+    
+    def __init__(self, payload_sink=None):
+        self.buffer = bytearray()
+        self.header = None # parsed header still waiting for its payload
+        self.offset = 0 # start of unprocessed bytes in buffer
+        self.payload_len = 0 # payload bytes the waiting header said will follow
+        self.payload_sink = payload_sink # called with each binary header, may return an object whose write() takes the payload instead
+        self.scanned = 0 # position in buffer already searched for a delimiter
+        self.sink = None # where the payload of the waiting header goes as it arrives
+    
+    # add received bytes and yield each complete message as (jsondata, rawdata)
+    # rawdata is a view into the receive buffer and is only valid until the next message is yielded, it is empty if the payload went to a sink
+    def feed(self, data):
+        self.buffer += data
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                if self.header is None:
+                    # find next message delimiter
+                    newjson_end = self.buffer.find(b'\r\n', max(self.offset, self.scanned))
+                    if newjson_end == -1:
+                        # don't have full header, need to receive more data
+                        self.scanned = max(self.offset, len(self.buffer) - 1)
+                        break
+                    
+                    if log.level >= LOG_WIRE: # skip copying the header out of the buffer unless it is going to be shown
+                        log.wire('RECV-EW', '94', bytes(self.buffer[self.offset:newjson_end]))
+                    
+                    try:
+                        newjson = json.loads(view[self.offset:newjson_end].tobytes())
+                    except (UnicodeDecodeError, json.decoder.JSONDecodeError): # message is not valid json
+                        newjson = None
+                    self.offset = newjson_end + 2
+                    if not isinstance(newjson, dict):
+                        continue
+                    
+                    self.header = newjson
+                    self.payload_len = 0
+                    self.sink = None
+                    if newjson.get('action', '') in self.binary_actions:
+                        # json message says it will have extra bytes following
+                        self.payload_len = int(newjson.get('size', 0))
+                        if self.payload_sink and self.payload_len > 0:
+                            self.sink = self.payload_sink(newjson)
+                
+                if self.sink is not None:
+                    # hand over extra bytes as they arrive, rather than keeping all of them in the buffer
+                    chunk_len = min(len(self.buffer) - self.offset, self.payload_len)
+                    self.sink.write(view[self.offset:(self.offset + chunk_len)])
+                    self.offset += chunk_len
+                    self.payload_len -= chunk_len
+                
+                if len(self.buffer) - self.offset < self.payload_len:
+                    # don't have full message with all extra bytes, need to receive more data
+                    break
+                
+                header = self.header
+                rawdata = view[self.offset:(self.offset + self.payload_len)]
+                self.header = None
+                self.offset += self.payload_len
+                try:
+                    yield header, rawdata
+                finally:
+                    rawdata.release()
+        finally:
+            view.release()
+            # drop processed bytes (cheap, bytearray only moves its start pointer when deleting from the front)
+            del self.buffer[:self.offset]
+            self.scanned = max(0, self.scanned - self.offset)
+            self.offset = 0
+
+
+
+
+
+
+# splits the vm receive stream into messages, lines that announce a length (XML state) are followed by that many bytes of payload
+class VMFrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.line = None # line still waiting for its payload
+        self.payload_len = 0
+    
+    # add received bytes and yield each complete message as (line, payload), payload being b'' for plain lines
+    def feed(self, data):
+        self.buffer += data
+        while True:
+            if self.line is None:
+                # find next message delimiter
+                line_end = self.buffer.find(b'\r\n')
+                if line_end == -1:
+                    break
+                line = bytes(self.buffer[:line_end])
+                del self.buffer[:(line_end + 2)]
+                log.wire('RECV-VM', '92', line)
+                if not line:
+                    continue
+                
+                self.line = line
+                self.payload_len = 0
+                words = line.split(b' ')
+                if words[0] == b'XML' and len(words) == 2 and words[1].isdigit():
+                    self.payload_len = int(words[1])
+            
+            if len(self.buffer) < self.payload_len:
+                # need to receive more data
+                break
+            
+            line, payload = self.line, bytes(self.buffer[:self.payload_len])
+            del self.buffer[:self.payload_len]
+            self.line = None
+            yield line, payload
+
+
+
+
+
+
+# live slide images as files in a directory vmix can read, named by imagehash so an image shown before is never received or written again
+# each image is written under a temporary name as it arrives and renamed once complete, so vmix never reads half an image
+class ImageStore:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.failed = False # writing the current image failed, the rest of it is ignored
+        self.file = None # image being written
+        self.files = {} # imagehash -> path
+        self.head = b'' # first bytes of the image being written, telling its format
+        self.imagehash = None # of the image being written
+    
+    # images written before, e.g. by an earlier run
+    def load(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            log.warning('Could not read image directory ' + self.directory + ' (' + str(e) + ').')
+            return
+        for name in names:
+            imagehash, extension = os.path.splitext(name)
+            if extension in ('.jpg', '.png') and not name.startswith('.'):
+                self.files[imagehash] = os.path.join(self.directory, name)
+    
+    def get(self, imagehash):
+        return self.files.get(imagehash)
+    
+    def part_path(self):
+        return os.path.join(self.directory, '.' + self.imagehash + '.part')
+    
+    # start writing the image of imagehash, returns self to write it to, or None if it cannot be written
+    def begin(self, imagehash):
+        self.abort()
+        if not re.fullmatch('[0-9A-Za-z_-]+', imagehash): # goes into a file name
+            return None
+        self.imagehash = imagehash
+        try:
+            self.file = open(self.part_path(), 'wb')
+        except OSError as e:
+            log.warning('Could not write image to ' + self.directory + ' (' + str(e) + ').')
+            return None
+        self.failed = False
+        self.head = b''
+        return self
+    
+    def write(self, data):
+        if self.file is None or self.failed:
+            return
+        if len(self.head) < 8:
+            self.head += bytes(data[:(8 - len(self.head))])
+        try:
+            self.file.write(data)
+        except OSError as e:
+            log.warning('Could not write image to ' + self.directory + ' (' + str(e) + ').')
+            self.failed = True
+    
+    # image complete, returns its path, or None if it could not be written
+    def finish(self):
+        if self.file is None:
+            return None
+        part_path = self.part_path()
+        path = os.path.join(self.directory, self.imagehash + ('.png' if self.head.startswith(b'\x89PNG') else '.jpg'))
+        try:
+            self.file.close()
+            if self.failed or not self.head:
+                raise OSError('image is empty or incomplete')
+            os.replace(part_path, path)
+        except OSError as e:
+            log.warning('Could not write image to ' + path + ' (' + str(e) + ').')
+            self.abort()
+            return None
+        self.file = None
+        self.files[self.imagehash] = path
+        return path
+    
+    # drop image being written, e.g. connection lost before all of it arrived
+    def abort(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+            os.remove(self.part_path())
+        except OSError:
+            pass
+        self.file = None
+
+
+
+
+
+
+# bounded LRU cache of slide info keyed by (pres_rowid, slide_rowid, revision), optionally persisted to a file
+class SlideCache:
+    def __init__(self, maxsize, path=None):
+        self.dirty = False
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.maxsize = maxsize
+        self.misses = 0
+        self.path = path
+        self.saving = None # thread writing the file in the background
+    
+    def get(self, key):
+        if self.maxsize < 1:
+            return None
+        info = self.entries.get(key)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return info
+    
+    # check for a slide without counting it as a hit or miss
+    def __contains__(self, key):
+        return key in self.entries
+    
+    def put(self, key, info):
+        if self.maxsize < 1:
+            return
+        if self.entries.get(key) != info:
+            self.dirty = True
+        self.entries[key] = info
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            # forget least recently used slide
+            self.entries.popitem(last=False)
+    
+    # read cache file left by a previous run, if any
+    def load(self):
+        if not self.path or self.maxsize < 1:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as cache_file:
+                for pres_rowid, slide_rowid, revision, info in json.load(cache_file):
+                    self.put((pres_rowid, slide_rowid, revision), info)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            log.warning('Could not read slide cache file ' + self.path + ' (' + str(e) + ').')
+        self.dirty = False
+    
+    # write cache file if anything changed, replacing the old one in one step so a crash never leaves it half-written
+    # in the background, a snapshot of the entries is written by another thread, so encoding a large cache does not hold up slides
+    def save(self, background=False):
+        if self.saving is not None and self.saving.is_alive():
+            if background:
+                return # still writing an earlier snapshot, the cache stays dirty for the next save
+            self.saving.join()
+        if not self.path or not self.dirty:
+            return
+        entries = [[key[0], key[1], key[2], info] for key, info in self.entries.items()] # info dicts are replaced, never changed, so they can be shared
+        self.dirty = False
+        if background:
+            self.saving = threading.Thread(target=self.write, args=(entries,), name='slide_cache_thread', daemon=True)
+            self.saving.start()
+        else:
+            self.write(entries)
+    
+    def write(self, entries):
+        try:
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            log.warning('Could not write slide cache file ' + self.path + ' (' + str(e) + ').')
+            self.dirty = True
+
+
+
+
+
+
+# one slide of the live presentation
+class Slide:
+    __slots__ = ('commands', 'content', 'id', 'info', 'info_received', 'info_requested', 'revision', 'slide_rowid', 'text', 'title', 'value')
+    
+    def __init__(self, id, slide_rowid, revision):
+        self.commands = None # SetText bytes for each vm link, rendered when info is received
+        self.content = None
+        self.id = id
+        self.info = None # slide info it was built from
+        self.info_received = False
+        self.info_requested = False
+        self.revision = revision
+        self.slide_rowid = slide_rowid
+        self.text = None # content as vmix will show it (see state_text), for comparing with its state
+        self.title = None
+        self.value = None # content as it goes into SetText
+
+
+
+
+
+
+# slides of the live presentation by slide_rowid, counting requested and received slides as they change so checking readiness needs no scan
+class SlideStore:
+    def __init__(self, pres_slides=()):
+        self.received = 0
+        self.requested = 0
+        self.slides = {slide_rowid: Slide(i, slide_rowid, revision) for i, (slide_rowid, revision) in enumerate(pres_slides)}
+    
+    def __len__(self):
+        return len(self.slides)
+    
+    def __contains__(self, slide_rowid):
+        return slide_rowid in self.slides
+    
+    def __getitem__(self, slide_rowid):
+        return self.slides[slide_rowid]
+    
+    def get(self, slide_rowid, default=None):
+        return self.slides.get(slide_rowid, default)
+    
+    def values(self):
+        return self.slides.values()
+    
+    # number of slides whose info has not arrived yet
+    def pending(self):
+        return len(self.slides) - self.received
+    
+    def mark_requested(self, slide):
+        if not slide.info_requested:
+            slide.info_requested = True
+            self.requested += 1
+    
+    # request given up on, so it is made again
+    def unmark_requested(self, slide):
+        if slide.info_requested and not slide.info_received:
+            slide.info_requested = False
+            self.requested -= 1
+    
+    def mark_received(self, slide):
+        self.mark_requested(slide)
+        if not slide.info_received:
+            slide.info_received = True
+            self.received += 1
+    
+
+
+
+
+
+
+# getSlideInfo requests by (pres_rowid, slide_rowid, revision), queued by priority and sent while fewer than the window are unanswered
+# the window grows by one per window of timely answers and halves when a live request times out, which is then sent again a few times
+class SlideInfoScheduler:
+    LIVE_SLIDE = 0 # slide that is live right now
+    LIVE = 1 # other slides and title of the live presentation
+    PREFETCH = 2 # upcoming presentations (and requests left over from a presentation that went off air), only while nothing else is in flight
+    retries = (3, 3, 1) # times a request is sent again after timing out, by priority
+    
+    def __init__(self, window, timeout):
+        self.abandoned = [] # (pres_rowid, slide_rowid, revision) of live requests given up on, for the bridge to ask for again when ew shows signs of life
+        self.inflight = collections.OrderedDict() # (pres_rowid, slide_rowid, revision) -> [priority, revision, sent, requestrev, attempts], oldest first
+        self.max_window = max(1, window)
+        self.queues = [collections.OrderedDict() for priority in range(3)] # (pres_rowid, slide_rowid, revision) -> (revision, attempts)
+        self.timeout = timeout
+        self.timeouts = 0
+        self.window = float(self.max_window)
+    
+    def __len__(self):
+        return len(self.inflight) + sum(len(queue) for queue in self.queues)
+    
+    # anything queued or unanswered
+    def busy(self):
+        return bool(self.inflight) or any(self.queues)
+    
+    # queue request, or raise the priority of one already queued or in flight (another revision of the slide, e.g. after an edit, is another request)
+    def request(self, priority, pres_rowid, slide_rowid, revision):
+        key = (pres_rowid, slide_rowid, revision)
+        if key in self.inflight:
+            self.inflight[key][0] = min(self.inflight[key][0], priority)
+            return
+        attempts = 0
+        for queued_priority, queue in enumerate(self.queues):
+            if key in queue:
+                if queued_priority <= priority:
+                    return
+                attempts = queue.pop(key)[1]
+                break
+        self.queues[priority][key] = (revision, attempts)
+    
+    # drop queued requests that are no longer needed, e.g. slides of a presentation that went off air or whose info arrived anyway
+    def cancel(self, priority):
+        self.queues[priority].clear()
+    
+    def discard(self, pres_rowid, slide_rowid, revision):
+        for queue in self.queues:
+            queue.pop((pres_rowid, slide_rowid, revision), None)
+    
+    # another presentation went live, requests for any other one are only worth prefetch priority, so they cannot hold up the new live slide
+    def demote(self, pres_rowid):
+        for key, entry in self.inflight.items():
+            if key[0] != pres_rowid:
+                entry[0] = self.PREFETCH
+        for queue in self.queues[:self.PREFETCH]:
+            for key in [key for key in queue if key[0] != pres_rowid]:
+                self.queues[self.PREFETCH][key] = queue.pop(key)
+    
+    # connection lost, requests in flight will never be answered, so they go first once connected again
+    def requeue(self):
+        for key, (priority, revision, sent, requestrev, attempts) in reversed(list(self.inflight.items())):
+            self.queues[priority][key] = (revision, attempts)
+            self.queues[priority].move_to_end(key, last=False)
+        self.inflight.clear()
+    
+    # slide info arrived, returns (pres_rowid, revision) of the request it answers, or None if it was not in flight
+    # ew answers in order, so slide 0 info (title) is for the oldest title request
+    def answered(self, slide_rowid):
+        for key in self.inflight:
+            if key[1] == slide_rowid:
+                priority, revision, sent, requestrev, attempts = self.inflight.pop(key)
+                self.window = min(self.max_window, self.window + (1 / self.window))
+                return key[0], revision
+        return None
+    
+    # send again what timed out, then take requests off the queues in order of priority as the window allows
+    # returns (pres_rowid, slide_rowid, revision) of each request to send
+    def pump(self, now, requestrev):
+        timed_out = [key for key, entry in self.inflight.items() if now - entry[2] >= self.timeout]
+        if timed_out:
+            self.timeouts += len(timed_out)
+            if any(self.inflight[key][0] < self.PREFETCH for key in timed_out):
+                self.window = max(1.0, self.window / 2)
+            for key in reversed(timed_out):
+                priority, revision, sent, requestrev_sent, attempts = self.inflight.pop(key)
+                retry = attempts < self.retries[priority]
+                log.info('INFO: No slide info for slide ' + str(key[1]) + ' of presentation ' + str(key[0]) + ' after ' + str(self.timeout) + ' s (requestrev ' + str(requestrev_sent) + '), ' + ('requesting again.' if retry else 'giving up.'))
+                if retry:
+                    self.queues[priority][key] = (revision, attempts + 1)
+                    self.queues[priority].move_to_end(key, last=False)
+                elif priority < self.PREFETCH:
+                    self.abandoned.append(key)
+        
+        requests = []
+        for priority, queue in enumerate(self.queues):
+            while queue and len(self.inflight) < int(self.window) and not (priority == self.PREFETCH and self.inflight):
+                key, (revision, attempts) = queue.popitem(last=False)
+                self.inflight[key] = [priority, revision, now, requestrev, attempts]
+                requests.append((key[0], key[1], revision))
+        return requests
+
+
+
+
+
+
+# counters, gauges and histograms of one bridge, rendered in Prometheus text format
+class Metrics:
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    batch_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+    
+    def __init__(self, labels=()):
+        self.families = collections.OrderedDict()
+        self.labels = tuple(labels) # added to every series, e.g. which bridge it belongs to
+        self.lock = threading.Lock()
+        self.declare('ew2vm_slide_latency_seconds', 'histogram', 'Time from receiving an EW status with a new slide to writing its SetText to the vMix socket', self.latency_buckets)
+        self.declare('ew2vm_ew_request_seconds', 'histogram', 'Time from queueing a request to EW to receiving its answer', self.latency_buckets)
+        self.declare('ew2vm_ew_process_seconds', 'histogram', 'Time spent processing one received EW message', self.latency_buckets)
+        self.declare('ew2vm_batch_messages', 'histogram', 'Messages written to a socket at once, i.e. transmit queue depth when it was emptied', self.batch_buckets)
+        self.declare('ew2vm_queue_messages', 'gauge', 'Messages waiting in the transmit queue')
+        self.declare('ew2vm_connected', 'gauge', '1 if the connection is up')
+        self.declare('ew2vm_received_bytes_total', 'counter', 'Bytes received')
+        self.declare('ew2vm_sent_bytes_total', 'counter', 'Bytes sent')
+        self.declare('ew2vm_connects_total', 'counter', 'Connections established, the first one included')
+        self.declare('ew2vm_coalesced_total', 'counter', 'vMix commands replaced by newer ones before being sent')
+        self.declare('ew2vm_slideinfo_window', 'gauge', 'getSlideInfo requests allowed in flight at once, as adapted to EW answering in time')
+        self.declare('ew2vm_slideinfo_inflight', 'gauge', 'getSlideInfo requests sent and not answered yet')
+        self.declare('ew2vm_vm_skipped_total', 'counter', 'vMix commands not sent because vMix already showed that text')
+        self.declare('ew2vm_vm_resynced_total', 'counter', 'vMix commands sent because vMix did not show what it should, e.g. after reconnecting')
+        self.declare('ew2vm_subscribers', 'gauge', 'Subscribers connected to the slide publisher')
+        self.declare('ew2vm_subscriber_resyncs_total', 'counter', 'Times a subscriber fell too far behind and was sent a fresh snapshot instead of its backlog')
+        self.declare('ew2vm_slideinfo_timeouts_total', 'counter', 'getSlideInfo requests not answered in time and sent again')
+        self.declare('ew2vm_rtt_seconds', 'histogram', 'Round trip time of heartbeats to EW and TALLY probes to vMix', self.latency_buckets)
+        self.declare('ew2vm_silence_drops_total', 'counter', 'Connections dropped and reconnected for sending nothing past their deadline')
+        self.declare('ew2vm_slide_cache_hits_total', 'counter', 'Slides whose text was found in the slide cache, needing no getSlideInfo request')
+        self.declare('ew2vm_slide_cache_misses_total', 'counter', 'Slides whose text was not in the slide cache')
+    
+    def declare(self, name, kind, description, buckets=None):
+        self.families[name] = (kind, description, buckets, {})
+    
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.families[name][3]
+            key = tuple(sorted(labels.items()))
+            series[key] = series.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.families[name][3][tuple(sorted(labels.items()))] = value
+    
+    def observe(self, name, value, **labels):
+        with self.lock:
+            kind, description, buckets, series = self.families[name]
+            key = tuple(sorted(labels.items()))
+            if key not in series:
+                series[key] = [[0] * len(buckets), 0, 0]
+            histogram = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    # text format, together with the metrics of other bridges if given
+    def render(self, *others):
+        lines = []
+        for name, (kind, description, buckets, series) in self.families.items():
+            lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for metrics in (self,) + others:
+                with metrics.lock:
+                    for key, value in metrics.families[name][3].items():
+                        key = metrics.labels + key
+                        if kind == 'histogram':
+                            for bound, count in zip(buckets, value[0]):
+                                lines.append(name + '_bucket' + metric_labels(key + (('le', repr(float(bound))),)) + ' ' + str(count))
+                            lines.append(name + '_bucket' + metric_labels(key + (('le', '+Inf'),)) + ' ' + str(value[2]))
+                            lines.append(name + '_sum' + metric_labels(key) + ' ' + repr(float(value[1])))
+                            lines.append(name + '_count' + metric_labels(key) + ' ' + str(value[2]))
+                        else:
+                            lines.append(name + metric_labels(key) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+
+
+
+
+
+# http server for the metrics of one or more bridges, GET /metrics, and their health, GET /healthz
+class MetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, bridges, host, port):
+        self.address_family = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)[0][0]
+        self.bridges = bridges
+        super().__init__((host, port), MetricsRequestHandler)
+    
+    # status 200 if every bridge is healthy (503 if not), with a line per bridge saying what is wrong and how fast its connections answer
+    def health(self):
+        lines = []
+        healthy = True
+        for bridge in self.bridges:
+            problems = bridge.health_problems()
+            healthy = healthy and not problems
+            lines.append(bridge.log_prefix + ('; '.join(problems) if problems else 'OK') + ' (' + bridge.rtt_line() + ')')
+        return (200 if healthy else 503), ('OK' if healthy else 'UNHEALTHY') + '\n' + '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            status = 200
+            body = self.server.bridges[0].metrics.render(*[bridge.metrics for bridge in self.server.bridges[1:]])
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/healthz':
+            status, body = self.server.health()
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    # scrapes are not worth a console line each
+    def log_message(self, format, *args):
+        pass
+
+
+
+
+
+
+# local server pushing what is on air to any number of subscribers as JSON lines: a snapshot on connect, then the fields that changed
+# one thread serves every subscriber, a subscriber more than max_backlog bytes behind gets its backlog replaced by a fresh snapshot
+class Publisher:
+    def __init__(self, host, port, max_backlog=65536):
+        family = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)[0][0]
+        self.clients = {} # socket -> bytes not sent yet
+        self.lock = threading.Lock()
+        self.max_backlog = max_backlog
+        self.pending = [] # update lines from the bridge, not handed to subscribers yet
+        self.resyncs = 0
+        self.selector = selectors.DefaultSelector()
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.server.bind((host, port))
+            self.server.listen()
+        except OSError:
+            self.server.close()
+            raise
+        self.server.setblocking(False)
+        self.state = {'title': None, 'credit': None, 'slide_title': None, 'text': None, 'visible': None}
+        self.stopping = False
+        self.waker, self.waker_send = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_send.setblocking(False)
+        self.worker = None
+    
+    def start(self):
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+        self.worker = threading.Thread(target=self.run, name='publish_thread', daemon=True)
+        self.worker.start()
+    
+    def stop(self):
+        self.stopping = True
+        self.wake()
+        self.worker.join()
+        for client in list(self.clients):
+            self.drop(client)
+        self.selector.close()
+        self.server.close()
+        self.waker.close()
+        self.waker_send.close()
+    
+    # called by the bridge with fields that may have changed, never waits for subscribers
+    def publish(self, **fields):
+        with self.lock:
+            changed = {key: value for key, value in fields.items() if self.state[key] != value}
+            if not changed:
+                return
+            self.state.update(changed)
+            self.pending.append(self.encode('update', changed))
+        self.wake()
+    
+    def wake(self):
+        try:
+            self.waker_send.send(b'\0')
+        except OSError: # already woken up plenty
+            pass
+    
+    def encode(self, kind, fields):
+        return (json.dumps(dict(fields, type=kind)) + '\n').encode('utf-8')
+    
+    def drop(self, client):
+        self.selector.unregister(client)
+        del self.clients[client]
+        client.close()
+    
+    # write as much of the backlog as the subscriber takes without blocking, wait for it to become writable for the rest
+    def flush(self, client):
+        try:
+            sent = client.send(self.clients[client])
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(client)
+            return
+        self.clients[client] = self.clients[client][sent:]
+        self.selector.modify(client, selectors.EVENT_READ | selectors.EVENT_WRITE if self.clients[client] else selectors.EVENT_READ)
+    
+    def run(self):
+        while not self.stopping:
+            for key, events in self.selector.select():
+                if key.fileobj is self.server:
+                    try:
+                        client, address = self.server.accept()
+                    except OSError:
+                        continue
+                    client.setblocking(False)
+                    self.selector.register(client, selectors.EVENT_READ)
+                    self.hand_updates(client)
+                elif key.fileobj is self.waker:
+                    try:
+                        while self.waker.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj in self.clients:
+                    if events & selectors.EVENT_READ:
+                        # subscribers have nothing to say, anything read is ignored, end of stream means they are gone
+                        try:
+                            data = key.fileobj.recv(4096)
+                        except BlockingIOError:
+                            data = None
+                        except OSError:
+                            data = b''
+                        if data == b'':
+                            self.drop(key.fileobj)
+                            continue
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(key.fileobj)
+            
+            self.hand_updates()
+    
+    # hand updates to every subscriber, a fresh snapshot to those too far behind
+    # and to a new subscriber, taken together with the updates so it gets none that its snapshot already has
+    def hand_updates(self, new_client=None):
+        with self.lock:
+            updates = b''.join(self.pending)
+            self.pending = []
+            snapshot = self.encode('snapshot', self.state) if updates or new_client else None
+            if new_client:
+                self.clients[new_client] = snapshot
+        if updates:
+            for client in list(self.clients):
+                if client is new_client:
+                    continue
+                backlog = self.clients[client]
+                if len(backlog) + len(updates) > self.max_backlog:
+                    # finish the line already partly sent, then start over
+                    self.clients[client] = backlog[:(backlog.find(b'\n') + 1)] + snapshot
+                    self.resyncs += 1
+                else:
+                    self.clients[client] += updates
+                self.flush(client)
+        if new_client:
+            self.flush(new_client)
+
+
+
+
+
+
+# raw byte streams of every connection written to a file as JSON lines, for replaying later with ew2vm_replay.py
+class Capture:
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.write({'event': 'start', 'argv': sys.argv[1:]})
+    
+    def write(self, record):
+        record['t'] = round(time.monotonic() - self.started, 6)
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(record, sort_keys=True) + '\n')
+    
+    def connect(self, link, host):
+        self.write({'event': 'connect', 'link': link, 'host': host})
+    
+    def data(self, link, host, direction, data):
+        self.write({'link': link, 'host': host, 'dir': direction, 'data': base64.b64encode(data).decode('ascii')})
+    
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+
+
+
+
+# delay between failed connection attempts: doubling from initial up to maximum, randomized so several instances don't retry in lockstep
+class Backoff:
+    def __init__(self, initial=0.25, maximum=5):
+        self.attempts = 0
+        self.initial = initial
+        self.maximum = maximum
+    
+    def reset(self):
+        self.attempts = 0
+    
+    # seconds to wait after another failure
+    def next(self):
+        delay = min(self.maximum, self.initial * (2 ** self.attempts))
+        self.attempts = min(self.attempts + 1, 32)
+        return delay * random.uniform(0.5, 1.5)
+
+
+
+
+
+
+# one vMix Title input that receives the slide text
+VMTarget = collections.namedtuple('VMTarget', ['host', 'input', 'textbox', 'textbox_credit'])
+
+
+
+
+
+
+# connection to one vMix instance, shared by all targets on that host
+class VMLink:
+    def __init__(self, host, min_interval):
+        self.backoff = Backoff()
+        self.connected = False
+        self.heard = 0 # when anything was last received from vmix
+        self.host = host
+        self.probe_sent = None # when TALLY was last sent to check vmix is still there, None once answered
+        self.resynced = 0 # commands sent because vmix did not show what it should
+        self.rtt = None # round trip time of the last TALLY answered
+        self.settext_prefixes = {'textbox': [], 'textbox_credit': []}
+        self.skipped = 0 # commands not sent because vmix already showed that
+        self.state = {} # (input, textbox) -> text vmix shows (see state_text), as last reported by vmix or since set by us
+        self.state_received = 0 # when vmix last reported its state
+        self.state_requested = None # when vmix was asked for its state, if it has not answered yet
+        self.state_wanted = False # state to be asked for once the last answer is old enough, see vm_request_state
+        self.targets = []
+        self.txqueue = CoalescingTxQueue(min_interval)
+        self.visible = None # 'On' or 'Off' as last set on this connection, vmix does not report it
+        self.visible_commands = {'On': b'', 'Off': b''}
+        self.wakeup = threading.Event() # set when the connection drops, so the threaded engine reconnects right away
+    
+    # add target, extending the commands that are the same for every slide
+    def add_target(self, target):
+        self.targets.append(target)
+        for textbox_field in self.settext_prefixes:
+            self.settext_prefixes[textbox_field].append(('FUNCTION SetText Input=' + str(target.input) + '&SelectedIndex=' + str(getattr(target, textbox_field)) + '&Value=').encode('utf-8'))
+        for onoff in self.visible_commands:
+            for textbox in (target.textbox, target.textbox_credit):
+                self.visible_commands[onoff] += ('FUNCTION SetTextVisible' + onoff + ' Input=' + str(target.input) + '&SelectedIndex=' + str(textbox) + '\r\n').encode('utf-8')
+        # text is shown only after whatever is queued with it has been set
+        self.txqueue.trailing[('visible',)] = self.visible_commands['On']
+    
+    # SetText of every target for the given textbox, from an already quoted value
+    def settext_command(self, textbox_field, value):
+        return b''.join(prefix + value + b'\r\n' for prefix in self.settext_prefixes[textbox_field])
+    
+    # whether every target already shows the text (see state_text) in the given textbox, and remembering that it will after sending
+    def shows(self, textbox_field, text):
+        return all(self.state.get((target.input, getattr(target, textbox_field))) == text for target in self.targets)
+    
+    def expect(self, textbox_field, text):
+        for target in self.targets:
+            self.state[(target.input, getattr(target, textbox_field))] = text
+    
+    # take textbox values of every target from the XML state of vmix, anything not found there is unknown
+    def update_state(self, vmix):
+        self.state.clear()
+        inputs = {target.input: target for target in self.targets}
+        for element in vmix.iter('input'):
+            target = inputs.get(int(element.get('number', 0)))
+            if target is None:
+                continue
+            for text in element.iter('text'):
+                index = int(text.get('index', -1))
+                if index in (target.textbox, target.textbox_credit):
+                    self.state[(target.input, index)] = state_text(text.text or '')
+
+
+
+
+
+
+# state of one ew to vm bridge, shared by whichever engine is moving its bytes
+class Bridge:
+    def __init__(self, args, name=None):
+        self.args = args
+        self.name = name # set in supervisor mode, tags its log lines and metrics
+        self.log_prefix = '[' + name + '] ' if name else ''
+        
+        self.capture = None
+        if args.capture:
+            try:
+                self.capture = Capture(args.capture)
+            except OSError as e:
+                log.warning('Could not open capture file ' + args.capture + ' (' + str(e) + ').')
+        
+        if args.presentation_filter:
+            self.presentation_filter_re = re.compile('(?:\\A|\\s)(' + '|'.join(args.presentation_filter) + ')(?:\\s|\\Z)', re.IGNORECASE)
+        else:
+            self.presentation_filter_re = None
+        
+        if args.credit_slide:
+            self.credit_slide_re = re.compile('(?:\\A|\\s)(' + '|'.join(args.credit_slide) + ')(?:\\s|\\Z)', re.IGNORECASE)
+        else:
+            self.credit_slide_re = re.compile('\\Z.')
+        
+        self.content_sent = None # value the main textbox should show, None until a slide was sent
+        self.content_shown = None # content_sent as vmix shows it
+        self.contentvisible = True
+        self.contentvisible_pending = False
+        self.credit = ''
+        self.credit_sent = None
+        self.credit_shown = None # credit_sent as vmix shows it
+        self.credit_value = None # credit_sent as it goes into SetText
+        self.ew_answers_heartbeats = False # whether ew answered a heartbeat on this connection, only then is its silence held against it
+        self.ew_backoff = Backoff()
+        self.ew_connected = False
+        self.ew_heard = 0 # when anything was last received from ew
+        self.ew_heartbeats = collections.deque(maxlen=100) # when each unanswered heartbeat was sent, in order (bounded, in case ew never answers them)
+        self.ew_port = None # port of the last successful connection, tried again before searching for ew
+        self.ew_received = 0 # when the data being processed was received
+        self.ew_requests = {}
+        self.ew_rtt = None # round trip time of the last heartbeat answered
+        self.ew_txqueue = TxQueue()
+        self.ew_wakeup = threading.Event() # set when the connection drops, so the threaded engine reconnects right away
+        self.imagehash = ''
+        self.imagehash_changed = None
+        self.imagehash_pending = ''
+        self.image_failed = None # imagehash whose GetCurrentImage went unanswered, not asked for again
+        self.image_request = None # (imagehash of the live output, when sent) of the one GetCurrentImage awaiting its answer, answers carry no id to match them by
+        self.image_sent = None # path of the image vm was last told to show
+        self.image_store = None
+        if args.image_dir:
+            self.image_store = ImageStore(args.image_dir)
+            self.image_store.load()
+        self.liverev = 0
+        self.liverev_pending = -1
+        self.livedata_requested = None
+        self.lock = threading.RLock()
+        self.metrics = Metrics((('bridge', name),) if name else ())
+        self.prefetch_next = 0
+        self.prefetch_queue = collections.deque()
+        self.pres_rowid = 0
+        self.presentation_filtered = True
+        self.publisher = None # Publisher of what is on air, set by main
+        self.requestrev = 0
+        self.schedule = []
+        self.schedule_requested_for = None
+        self.schedulerev = None
+        self.slide_cache = SlideCache(args.slide_cache_size, args.slide_cache_file)
+        self.slide_cache.load()
+        self.slideinfo_scheduler = SlideInfoScheduler(args.slideinfo_window, args.slideinfo_timeout)
+        self.slide_rowid_pending = -1
+        self.slides = SlideStore()
+        self.title = ''
+        self.title_revision = 0
+        
+        # pool targets by host, one connection per vMix instance
+        self.vm_links = []
+        for host, vm_input, textbox, textbox_credit in (args.vm_target or [(args.vm_host, args.vm_input, None, None)]):
+            target = VMTarget(host, vm_input, args.vm_textbox if textbox is None else textbox, args.vm_textbox_credit if textbox_credit is None else textbox_credit)
+            for link in self.vm_links:
+                if link.host == host:
+                    break
+            else:
+                link = VMLink(host, args.vm_min_interval)
+                self.vm_links.append(link)
+            link.add_target(target)
+        
+        if args.prefetch > 0 and args.slide_cache_size < 1:
+            log.warning('Prefetching needs the slide cache, --prefetch has no effect with --slide-cache-size 0.')
+    
+    
+    # hello to ew
+    def ew_hello(self):
+        device_name = 'ew2vm (' + ', '.join('Input ' + str(target.input) + ' @ ' + target.host for link in self.vm_links for target in link.targets) + ')'
+        self.ew_txqueue.append(('{"device_type":0,"action":"connect","uid":"' + self.args.ew_client_id + '","device_name":' + json.dumps(device_name) + '}\r\n').encode('utf-8'))
+        
+        # requests of a previous connection will never be answered
+        self.ew_answers_heartbeats = False
+        self.ew_heard = time.monotonic()
+        self.ew_heartbeats.clear()
+        self.ew_requests.clear()
+        self.image_request = None
+        self.livedata_requested = None
+        if self.image_store:
+            self.image_store.abort()
+        
+        # keep what is loaded of the live presentation, only ask again for what was asked for but never arrived
+        self.slideinfo_scheduler.requeue()
+        if self.args.prefetch > 0:
+            self.schedulerev = None
+            self.request_schedule()
+    
+    
+    # keepalive to ew, timed until ew answers it
+    def ew_heartbeat(self):
+        self.ew_heartbeats.append(time.monotonic())
+        return ('{"action":"heartbeat","requestrev":' + str(self.requestrev) + '}\r\n').encode('utf-8')
+    
+    
+    # process received ew message
+    def procmsg_ew(self, jsondata, rawdata):
+        args = self.args
+        presentation_loaded = False
+        processing_started = time.monotonic()
+        
+        if 'requestrev' in jsondata:
+            self.requestrev = int(jsondata['requestrev'])
+    
+        if 'action' in jsondata:
+                        
+            if jsondata['action'] == 'status':                
+                if 'liverev' in jsondata:
+                    self.liverev_pending = int(jsondata['liverev'])
+                if 'imagehash' in jsondata:
+                    if jsondata['imagehash'] != self.imagehash_pending:
+                        # new slide, measure from here until its text goes out to vm
+                        self.imagehash_changed = self.ew_received
+                    self.imagehash_pending = jsondata['imagehash']
+                    self.slide_rowid_pending = int(jsondata.get('slide_rowid', -1))
+                    if self.image_store:
+                        self.forward_image()
+                if 'schedulerev' in jsondata and self.args.prefetch > 0:
+                    if self.schedulerev is not None and self.schedulerev != int(jsondata['schedulerev']):
+                        self.request_schedule()
+                    self.schedulerev = int(jsondata['schedulerev'])
+                if True in [bool(jsondata.get('logo', False)), bool(jsondata.get('black', False)), bool(jsondata.get('clear', False))]:
+                    self.contentvisible_pending = False
+                else:
+                    self.contentvisible_pending = True
+    
+    
+            elif jsondata['action'] == 'LiveData':
+                self.ew_answered('GetLiveData')
+                
+                # unpack raw data
+                try:
+                    liverev, pres_rowid, title_revision, pres_slides, offset = unpack_presentation(rawdata)
+                except struct.error as e:
+                    # keep the slides loaded so far, the next presentation/song (or reconnect) asks again
+                    log.warning('Could not unpack live presentation (' + str(e) + '), ignoring it.')
+                    return
+                
+                # same presentation as before (e.g. after a reconnect, or edited), slides with unchanged revision can be kept
+                previous_slides = self.slides if pres_rowid == self.pres_rowid else SlideStore()
+                previous_title = self.title if (pres_rowid, title_revision) == (self.pres_rowid, self.title_revision) else ''
+                
+                # clear stored slides
+                self.credit = ''
+                self.presentation_filtered = True
+                self.slides = SlideStore(pres_slides)
+                self.title = ''
+                self.liverev, self.pres_rowid, self.title_revision = liverev, pres_rowid, title_revision
+                self.slideinfo_scheduler.demote(pres_rowid)
+                
+                info = self.slide_cache.get((self.pres_rowid, 0, self.title_revision)) if not previous_title else None
+                if previous_title:
+                    self.title = previous_title
+                elif info is not None:
+                    self.title = info.get('title', '')
+                else:
+                    # request title info, unless already on its way (e.g. asked for while prefetching)
+                    self.slideinfo_scheduler.request(SlideInfoScheduler.LIVE, self.pres_rowid, 0, self.title_revision)
+                
+                # fill in what is already known of each slide
+                for slide in self.slides.values():
+                    # slide seen before with same revision, no need to ask ew again
+                    previous_slide = previous_slides.get(slide.slide_rowid)
+                    if previous_slide is not None and previous_slide.revision == slide.revision and previous_slide.info_received:
+                        info = previous_slide.info
+                    else:
+                        info = self.slide_cache.get((self.pres_rowid, slide.slide_rowid, slide.revision))
+                    if info is not None:
+                        self.store_slideinfo(slide, info)
+                
+                log.info('INFO: Slide cache ' + str(self.slide_cache.hits) + ' hits, ' + str(self.slide_cache.misses) + ' misses.')
+                self.prefetch_plan()
+    
+    
+            elif jsondata['action'] == 'heartbeat':
+                # answers come in the order the heartbeats were sent
+                if self.ew_heartbeats:
+                    self.ew_rtt = self.ew_received - self.ew_heartbeats.popleft()
+                    self.ew_answers_heartbeats = True
+                    self.metrics.observe('ew2vm_rtt_seconds', self.ew_rtt, link='ew', host=self.args.ew_host)
+            
+            elif jsondata['action'] == 'currentImage':
+                self.ew_answered('GetCurrentImage')
+                imagehash = self.image_request[0] if self.image_request else None
+                self.image_request = None
+                if self.image_store and imagehash is not None:
+                    if self.image_store.file is None and len(rawdata) > 0 and imagehash == self.imagehash_pending and self.image_store.begin(imagehash): # payload was not streamed to the store
+                        self.image_store.write(rawdata)
+                    path = self.image_store.finish()
+                    if path and imagehash == self.imagehash_pending:
+                        self.send_image(path)
+                    # slide changed while waiting, ask for the image now live
+                    self.forward_image()
+            
+            elif jsondata['action'] == 'ScheduleData':
+                self.ew_answered('GetScheduleData')
+                try:
+                    # unpack raw data, each schedule item is laid out like LiveData
+                    schedule = []
+                    unknownrawdata0, schedule_len = struct.unpack_from('<ll', rawdata, 0)
+                    offset = 8
+                    for i in range(schedule_len):
+                        rev, pres_rowid, title_revision, pres_slides, offset = unpack_presentation(rawdata, offset)
+                        schedule.append((pres_rowid, title_revision, pres_slides))
+                    if offset != len(rawdata): # layout not as expected, rather not prefetch than ask for made-up slides
+                        raise struct.error('schedule is ' + str(len(rawdata)) + ' bytes, not ' + str(offset))
+                except struct.error as e:
+                    log.warning('Could not unpack schedule (' + str(e) + '), not prefetching.')
+                    self.schedule = []
+                else:
+                    self.schedule = schedule
+                self.prefetch_plan()
+                                                  
+    
+            elif jsondata['action'] == 'slideInfo' and 'slide_rowid' in jsondata:
+                slide_rowid = int(jsondata['slide_rowid'])
+                self.ew_answered('getSlideInfo', slide_rowid)
+                info = {key: jsondata[key] for key in ('title', 'content') if key in jsondata}
+                
+                # the request tells which presentation and revision the info is for (slide 0 info is for the song title of any presentation)
+                request = self.slideinfo_scheduler.answered(slide_rowid)
+                if request is None and slide_rowid == 0:
+                    request = (self.pres_rowid, self.title_revision)
+                if request is not None and (slide_rowid != 0 or 'title' in jsondata):
+                    self.slide_cache.put((request[0], slide_rowid, request[1]), info)
+                if slide_rowid == 0 and 'title' in jsondata and request == (self.pres_rowid, self.title_revision):
+                    self.title = jsondata['title']
+                
+                # info is for a valid slide, as it is now (an answer for a revision since edited is only good for the cache)
+                if slide_rowid in self.slides and request == (self.pres_rowid, self.slides[slide_rowid].revision):
+                    self.slideinfo_scheduler.discard(self.pres_rowid, slide_rowid, request[1]) # answer to a request that timed out arrived after all
+                    self.store_slideinfo(self.slides[slide_rowid], info)
+        
+        
+        if self.contentvisible_pending: # content should be visible
+            
+            if self.imagehash_pending != self.imagehash: # outdated content is currently output
+                
+                if self.liverev_pending != self.liverev: # outdated slides are currently loaded
+                    if self.livedata_requested != self.liverev_pending: # not already waiting for the new song
+                        # drop slide info requests not sent yet, stored slides are kept until LiveData tells which of them are still valid
+                        self.slideinfo_scheduler.cancel(SlideInfoScheduler.LIVE_SLIDE)
+                        self.slideinfo_scheduler.cancel(SlideInfoScheduler.LIVE)
+                        # request data about new song
+                        self.ew_request(('{"action":"GetLiveData","requestrev":' + str(self.requestrev) + '}\r\n').encode('utf-8'), 'GetLiveData')
+                        self.livedata_requested = self.liverev_pending
+                
+                else:
+                    # make sure all slides are loaded, live slide first
+                    if self.slide_rowid_pending in self.slides:
+                        self.request_slideinfo(self.slides[self.slide_rowid_pending], SlideInfoScheduler.LIVE_SLIDE)
+                    if self.slides.requested < len(self.slides):
+                        for slide in self.slides.values():
+                            self.request_slideinfo(slide, SlideInfoScheduler.LIVE)
+                    waiting_for_slideinfo = self.slides.pending() > 0
+                    
+                    if self.slide_rowid_pending not in self.slides:
+                        ready = False
+                    elif args.progressive:
+                        # live slide is enough, unless it is not known yet whether the presentation passes the filter
+                        ready = self.slides[self.slide_rowid_pending].info_received and not (waiting_for_slideinfo and self.presentation_filtered)
+                    else:
+                        ready = not waiting_for_slideinfo
+                        
+                    if ready:
+                        presentation_loaded = not waiting_for_slideinfo
+                        if self.presentation_filtered:
+                            log.info('INFO: Presentation ignored by filter ("' + '" or "'.join(args.presentation_filter) + '").')
+                            self.contentvisible_pending = False
+                        else:
+                            if self.slides[self.slide_rowid_pending].commands is not None: # we have the content of the new slide
+                                self.send_content(self.slides[self.slide_rowid_pending])
+                                self.send_credit(self.credit_text(presentation_loaded))
+                                self.imagehash = self.imagehash_pending
+            
+            elif args.progressive and jsondata.get('action', '') == 'slideInfo' and self.slides:
+                # live slide is already output, remaining slides may bring a custom credit slide (or the title)
+                presentation_loaded = self.slides.pending() == 0
+                self.send_credit(self.credit_text(presentation_loaded))
+                                
+            if self.imagehash_pending == self.imagehash: # correct content is currently output
+                if not self.contentvisible: # content should be visible but is currently hidden
+                    # send unhide commands to vm
+                    self.send_visible('On')
+                    self.contentvisible = True
+                    
+        if (not self.contentvisible_pending) and self.contentvisible: # content should be hidden but is currently visible
+            # send hide commands to vm
+            self.send_visible('Off')
+            self.contentvisible = False
+        
+        # remember newly loaded slides across restarts, once vm is taken care of
+        if presentation_loaded:
+            self.slide_cache.save(background=True)
+        
+        self.prefetch_pump()
+        self.send_slideinfo_requests()
+        
+        self.metrics.observe('ew2vm_ew_process_seconds', time.monotonic() - processing_started, action=str(jsondata.get('action', '')))
+    
+    
+    # timers, called by the engine every 100 ms or so
+    def tick(self):
+        self.prefetch_pump()
+        self.send_slideinfo_requests()
+        self.check_liveness()
+        if self.image_store:
+            self.expire_image_request()
+        
+        # sample queues for the metrics
+        self.metrics.set('ew2vm_slideinfo_window', int(self.slideinfo_scheduler.window))
+        self.metrics.set('ew2vm_slideinfo_inflight', len(self.slideinfo_scheduler.inflight))
+        self.metrics.set('ew2vm_slideinfo_timeouts_total', self.slideinfo_scheduler.timeouts)
+        self.metrics.set('ew2vm_slide_cache_hits_total', self.slide_cache.hits)
+        self.metrics.set('ew2vm_slide_cache_misses_total', self.slide_cache.misses)
+        self.metrics.set('ew2vm_queue_messages', len(self.ew_txqueue), link='ew', host=self.args.ew_host)
+        self.metrics.set('ew2vm_connected', int(self.ew_connected), link='ew', host=self.args.ew_host)
+        for link in self.vm_links:
+            # vm state: re-read every --vm-state-interval, corrected blindly if vm does not answer
+            now = time.monotonic()
+            if link.connected and link.state_requested is not None and now - link.state_requested > 2:
+                link.state_requested = None
+                self.vm_resync(link)
+            elif link.connected and (link.state_wanted or (self.args.vm_state_interval > 0 and now - link.state_received >= self.args.vm_state_interval)):
+                self.vm_request_state(link)
+            
+            self.metrics.set('ew2vm_vm_skipped_total', link.skipped, host=link.host)
+            self.metrics.set('ew2vm_vm_resynced_total', link.resynced, host=link.host)
+            self.metrics.set('ew2vm_queue_messages', len(link.txqueue), link='vm', host=link.host)
+            self.metrics.set('ew2vm_connected', int(link.connected), link='vm', host=link.host)
+            self.metrics.set('ew2vm_coalesced_total', link.txqueue.coalesced, host=link.host)
+        if self.publisher:
+            self.metrics.set('ew2vm_subscribers', len(self.publisher.clients))
+            self.metrics.set('ew2vm_subscriber_resyncs_total', self.publisher.resyncs)
+    
+    
+    # drop connections that went silent past their deadline (e.g. half-open after a network outage), the engine reconnects at once
+    def check_liveness(self):
+        now = time.monotonic()
+        ew_deadline = self.args.ew_deadline
+        if self.ew_connected and ew_deadline > 0 and self.ew_answers_heartbeats and now - self.ew_heard > ew_deadline:
+            log.warning('EW at ' + self.args.ew_host + ' has sent nothing for ' + str(round(now - self.ew_heard, 1)) + ' s, reconnecting.')
+            self.metrics.inc('ew2vm_silence_drops_total', link='ew', host=self.args.ew_host)
+            self.ew_connected = False
+            self.ew_wakeup.set()
+        
+        # vm is probed with TALLY, once per quiet spell, as it never speaks unprompted while nothing changes
+        vm_deadline = self.args.vm_deadline
+        for link in self.vm_links:
+            if not link.connected or vm_deadline <= 0:
+                continue
+            if now - link.heard > vm_deadline:
+                log.warning('VM at ' + link.host + ' has sent nothing for ' + str(round(now - link.heard, 1)) + ' s, reconnecting.')
+                self.metrics.inc('ew2vm_silence_drops_total', link='vm', host=link.host)
+                link.connected = False
+                link.wakeup.set()
+            elif now - link.heard >= vm_deadline / 3 and (link.probe_sent is None or link.probe_sent < link.heard):
+                link.txqueue.append(b'TALLY\r\n')
+                link.probe_sent = now
+    
+    
+    # what is wrong with this bridge, nothing if healthy: connections down, or answering so slowly that they are close to their deadline
+    def health_problems(self):
+        problems = []
+        if not self.ew_connected:
+            problems.append('EW not connected')
+        elif self.args.ew_deadline > 0 and self.ew_rtt is not None and self.ew_rtt > self.args.ew_deadline / 2:
+            problems.append('EW round trip ' + str(round(self.ew_rtt * 1000)) + ' ms')
+        for link in self.vm_links:
+            if not link.connected:
+                problems.append('VM at ' + link.host + ' not connected')
+            elif self.args.vm_deadline > 0 and link.rtt is not None and link.rtt > self.args.vm_deadline / 2:
+                problems.append('VM at ' + link.host + ' round trip ' + str(round(link.rtt * 1000)) + ' ms')
+        return problems
+    
+    
+    # round trip times of the connections, for the health report
+    def rtt_line(self):
+        rtts = [('EW', self.ew_rtt)] + [('VM at ' + link.host, link.rtt) for link in self.vm_links]
+        return ', '.join(description + ' round trip ' + ('unknown' if rtt is None else str(round(rtt * 1000, 1)) + ' ms') for description, rtt in rtts)
+    
+    
+    # queue request to ew, timing it until ew_answered is called with the same request and key
+    def ew_request(self, message, request, key=None):
+        self.ew_txqueue.append(message)
+        self.ew_requests[(request, key)] = time.monotonic()
+    
+    
+    # answer to a request has arrived
+    def ew_answered(self, request, key=None):
+        requested = self.ew_requests.pop((request, key), None)
+        if requested is not None:
+            self.metrics.observe('ew2vm_ew_request_seconds', self.ew_received - requested, request=request)
+    
+    
+    # request the service schedule
+    def request_schedule(self):
+        self.ew_request(('{"action":"GetScheduleData","requestrev":' + str(self.requestrev) + '}\r\n').encode('utf-8'), 'GetScheduleData')
+    
+    
+    # queue the slide info requests the scheduler lets through (and those timed out) to ew
+    def send_slideinfo_requests(self):
+        if not self.ew_connected:
+            return
+        for pres_rowid, slide_rowid, revision in self.slideinfo_scheduler.pump(time.monotonic(), self.requestrev):
+            self.ew_request(slideinfo_request(pres_rowid, slide_rowid, revision, self.requestrev), 'getSlideInfo', slide_rowid)
+        # slides of the live presentation given up on are requested again with the next message from ew
+        for pres_rowid, slide_rowid, revision in self.slideinfo_scheduler.abandoned:
+            if pres_rowid == self.pres_rowid and slide_rowid in self.slides and self.slides[slide_rowid].revision == revision:
+                self.slides.unmark_requested(self.slides[slide_rowid])
+        del self.slideinfo_scheduler.abandoned[:]
+    
+    
+    # queue slides of the presentations following the live one in the schedule for prefetching
+    def prefetch_plan(self):
+        self.prefetch_queue.clear()
+        if self.args.prefetch < 1 or self.args.slide_cache_size < 1:
+            return
+        for index, (pres_rowid, title_revision, pres_slides) in enumerate(self.schedule):
+            if pres_rowid == self.pres_rowid:
+                break
+        else:
+            # live presentation is not in the schedule as we know it, so the schedule probably changed
+            if self.schedule_requested_for != self.pres_rowid:
+                self.schedule_requested_for = self.pres_rowid
+                self.request_schedule()
+            return
+        for pres_rowid, title_revision, pres_slides in self.schedule[(index + 1):(index + 1 + self.args.prefetch)]:
+            self.prefetch_queue.append((pres_rowid, 0, title_revision))
+            for slide_rowid, revision in pres_slides:
+                self.prefetch_queue.append((pres_rowid, slide_rowid, revision))
+    
+    
+    # request one queued prefetch slide at a time, at most --prefetch-rate per second, and only while no other slide info is needed
+    def prefetch_pump(self):
+        if not self.prefetch_queue or not self.ew_connected:
+            return
+        if self.slideinfo_scheduler.busy() or time.monotonic() < self.prefetch_next:
+            return
+        if self.liverev_pending != self.liverev or self.slides.pending() > 0:
+            return
+        while self.prefetch_queue:
+            pres_rowid, slide_rowid, revision = self.prefetch_queue.popleft()
+            if pres_rowid == self.pres_rowid or (pres_rowid, slide_rowid, revision) in self.slide_cache:
+                continue
+            self.slideinfo_scheduler.request(SlideInfoScheduler.PREFETCH, pres_rowid, slide_rowid, revision)
+            self.prefetch_next = time.monotonic() + (1 / self.args.prefetch_rate)
+            return
+    
+    
+    # request more info of slide, unless already done (the live slide may need moving ahead of the others)
+    def request_slideinfo(self, slide, priority):
+        if not slide.info_received and (priority == SlideInfoScheduler.LIVE_SLIDE or not slide.info_requested):
+            self.slideinfo_scheduler.request(priority, self.pres_rowid, slide.slide_rowid, slide.revision)
+            self.slides.mark_requested(slide)
+    
+    
+    # check if we have custom credit text to send, otherwise use song title
+    def credit_text(self, presentation_loaded):
+        if self.credit != '':
+            return self.credit
+        if presentation_loaded:
+            log.info('INFO: No custom credit slide ("' + '" or "'.join(self.args.credit_slide) + '") loaded, resorting to title.')
+        return self.title
+    
+    
+    # send content of slide to vm, as rendered when its info arrived
+    def send_content(self, slide):
+        for link, command in zip(self.vm_links, slide.commands):
+            if link.shows('textbox', slide.text):
+                if self.content_sent != slide.value:
+                    link.skipped += 1
+                continue
+            link.txqueue.append(command, ('textbox', 'text'), self.imagehash_changed)
+            link.expect('textbox', slide.text)
+        self.content_sent = slide.value
+        self.content_shown = slide.text
+        self.publish(slide_title=slide.title, text=slide.content)
+    
+    
+    # send credit/title to vm
+    def send_credit(self, credit_new):
+        if self.credit_sent != credit_new:
+            self.credit_value, self.credit_shown = self.render_text(credit_new)
+            for link in self.vm_links:
+                if link.shows('textbox_credit', self.credit_shown):
+                    link.skipped += 1
+                    continue
+                link.txqueue.append(link.settext_command('textbox_credit', self.credit_value), ('textbox_credit', 'text'))
+                link.expect('textbox_credit', self.credit_shown)
+            self.credit_sent = credit_new
+        self.publish(title=self.title, credit=credit_new)
+    
+    
+    # show image of the live output on vm, asking ew for it unless it is already stored
+    # one request at a time, a slide going live meanwhile is asked for once the answer arrives (and the stale image is dropped)
+    def forward_image(self):
+        path = self.image_store.get(self.imagehash_pending)
+        if path:
+            self.send_image(path)
+        elif self.imagehash_pending and self.imagehash_pending != self.image_failed and self.image_request is None and self.ew_connected:
+            self.ew_request(('{"action":"GetCurrentImage","requestrev":' + str(self.requestrev) + '}\r\n').encode('utf-8'), 'GetCurrentImage')
+            self.image_request = (self.imagehash_pending, time.monotonic())
+    
+    
+    # give up on an image request ew has not started answering in time, so a lost answer does not hold up the images that follow
+    def expire_image_request(self):
+        if self.image_request is None or self.image_store.file is not None or time.monotonic() - self.image_request[1] < self.args.image_timeout:
+            return
+        log.info('INFO: No image from EW after ' + str(self.args.image_timeout) + ' s, not asking for that one again.')
+        self.image_failed = self.image_request[0]
+        self.image_request = None
+        self.forward_image()
+    
+    
+    # where the decoder streams the payload of an image as it arrives: the image store, if the image is the one that was asked for and still live
+    def image_sink(self, jsondata):
+        with self.lock:
+            if jsondata.get('action') != 'currentImage' or self.image_request is None or self.image_request[0] != self.imagehash_pending:
+                return None
+            return self.image_store.begin(self.image_request[0])
+    
+    
+    def send_image(self, path):
+        if self.image_sent != path and self.args.vm_image_input is not None:
+            command = ('FUNCTION SetImage Input=' + str(self.args.vm_image_input) + '&SelectedIndex=' + str(self.args.vm_image_index) + '&Value=' + urllib.parse.quote(path) + '\r\n').encode('utf-8')
+            for link in self.vm_links:
+                link.txqueue.append(command, ('image',))
+        self.image_sent = path
+    
+    
+    # show/hide both textboxes of every target
+    def send_visible(self, onoff):
+        for link in self.vm_links:
+            if link.visible != onoff:
+                link.txqueue.append(link.visible_commands[onoff], ('visible',))
+                link.visible = onoff
+        self.publish(visible=(onoff == 'On'))
+    
+    
+    # tell subscribers what is on air, if serving them
+    def publish(self, **fields):
+        if self.publisher:
+            self.publisher.publish(**fields)
+    
+    
+    # apply text transforms from the command line, returns value ready for a SetText command and the text vmix will show for it (see state_text)
+    def render_text(self, text, max_lines=0):
+        args = self.args
+        if args.normalize_whitespace:
+            text = '\n'.join(' '.join(line.split()) for line in text.splitlines() if line.strip())
+        if max_lines > 0:
+            text = '\n'.join(text.splitlines()[:max_lines])
+        if args.uppercase:
+            text = text.upper()
+        return urllib.parse.quote(text).encode('utf-8'), state_text(text)
+    
+    
+    # store text of a slide, from ew or from the slide cache
+    def store_slideinfo(self, slide, info):
+        slide.info = info
+        if self.credit_slide_re.search(info.get('title', '')): # slide is a special slide of custom song credits
+            self.credit = info.get('content', '')
+            # store blank lyrics for this slide
+            slide.content = ''
+            
+        else: # info is for regular slide
+            if 'content' in info:
+                slide.content = info['content']
+            if 'title' in info:
+                slide.title = info['title']
+        
+        # render the slide for vm now, so going live is only a matter of queueing these bytes
+        if slide.content is not None:
+            slide.value, slide.text = self.render_text(slide.content, self.args.max_lines)
+            slide.commands = [link.settext_command('textbox', slide.value) for link in self.vm_links]
+                
+        self.slides.mark_received(slide)
+        
+        if not self.presentation_filter_re: # presentation filtering is not enabled
+            self.presentation_filtered = False
+        else:
+            if self.presentation_filter_re.search(info.get('title', '')): # slide title matches filter
+                self.presentation_filtered = False
+    
+    
+    # a connection to ew or vm was established
+    def record_connect(self, link, host):
+        self.metrics.inc('ew2vm_connects_total', link=link, host=host)
+        if self.capture:
+            self.capture.connect(link, host)
+    
+    
+    # one line summary, shown in supervisor mode whenever it changes
+    def status_line(self):
+        status = 'EW ' + ('connected' if self.ew_connected else 'not connected') + ', VM ' + str(sum(1 for link in self.vm_links if link.connected)) + '/' + str(len(self.vm_links)) + ' connected'
+        slide = self.slides.get(self.slide_rowid_pending)
+        if slide is not None:
+            status += ', "' + self.title + '" slide ' + str(slide.id + 1) + '/' + str(len(self.slides))
+        return status + (', text shown' if self.contentvisible else ', text hidden')
+    
+    
+    # bytes went over a connection to ew or vm
+    def record_io(self, link, host, direction, data):
+        self.metrics.inc('ew2vm_received_bytes_total' if direction == 'rx' else 'ew2vm_sent_bytes_total', len(data), link=link, host=host)
+        if self.capture:
+            self.capture.data(link, host, direction, data)
+    
+    
+    # new connection to vm, what it shows is unknown until it reports its state, so ask for it and for activity that may change it
+    def vm_connected(self, link):
+        link.heard = time.monotonic()
+        link.probe_sent = None
+        link.state.clear()
+        link.state_received = 0
+        link.state_requested = None
+        link.visible = None
+        link.txqueue.append(b'SUBSCRIBE ACTS\r\n')
+        self.vm_request_state(link)
+    
+    
+    # ask vm for its state, at most once a second as the whole XML is sizeable, a request within that second is sent once it has passed (by tick)
+    def vm_request_state(self, link):
+        if link.state_requested is not None:
+            return
+        if time.monotonic() - link.state_received < 1:
+            link.state_wanted = True
+            return
+        link.txqueue.append(b'XML\r\n')
+        link.state_requested = time.monotonic()
+        link.state_wanted = False
+    
+    
+    # send whatever vm does not show but should, once its state is known (or it failed to report it)
+    def vm_resync(self, link):
+        if self.content_sent is None: # nothing sent yet, leave vm as it is
+            return
+        resynced = link.resynced
+        if not link.shows('textbox', self.content_shown):
+            link.txqueue.append(link.settext_command('textbox', self.content_sent), ('textbox', 'text'))
+            link.expect('textbox', self.content_shown)
+            link.resynced += 1
+        if self.credit_value is not None and not link.shows('textbox_credit', self.credit_shown):
+            link.txqueue.append(link.settext_command('textbox_credit', self.credit_value), ('textbox_credit', 'text'))
+            link.expect('textbox_credit', self.credit_shown)
+            link.resynced += 1
+        onoff = 'On' if self.contentvisible else 'Off'
+        if link.visible != onoff:
+            link.txqueue.append(link.visible_commands[onoff], ('visible',))
+            link.visible = onoff
+            link.resynced += 1
+        if link.resynced > resynced:
+            log.info('INFO: Sent ' + str(link.resynced - resynced) + ' command(s) to bring VM at ' + link.host + ' in line with the live slide.')
+    
+    
+    # process received vm message: its state (as parsed by parse_vm_state), activity that may have changed it, commands it could not carry out
+    def procmsg_vm(self, link, message, vmix):
+        if message.startswith(b'XML '):
+            link.state_requested = None
+            link.state_received = time.monotonic()
+            if vmix is None:
+                return
+            link.update_state(vmix)
+            self.vm_resync(link)
+        elif message.startswith(b'ACTS OK ') and not self.args.vm_ignore_activity:
+            # only activity of an input we send to (ACTS OK <activator> <input> <value>), e.g. it going live, may have come with edits
+            words = message.split(b' ')
+            if len(words) >= 4 and words[3].isdigit() and any(target.input == int(words[3]) for target in link.targets):
+                self.vm_request_state(link)
+        elif message.startswith(b'FUNCTION ER ') and not self.args.vm_ignore_activity:
+            self.vm_request_state(link)
+        elif message.startswith(b'TALLY OK') and link.probe_sent is not None:
+            link.rtt = time.monotonic() - link.probe_sent
+            link.probe_sent = None
+            self.metrics.observe('ew2vm_rtt_seconds', link.rtt, link='vm', host=link.host)
+
+
+
+
+
+
+# getSlideInfo request for one slide (slide 0 being the presentation title)
+def slideinfo_request(pres_rowid, slide_rowid, revision, requestrev):
+    return ('{"slide_rowid":' + str(slide_rowid) + ',"revision":' + str(revision) + ',"action":"getSlideInfo","requestrev":' + str(requestrev) + ',"rectype":1,"pres_rowid":' + str(pres_rowid) + '}\r\n').encode('utf-8')
+
+
+# textbox value as compared with what vmix reports, XML parsing having turned its line endings into \n
+def state_text(text):
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+# prometheus label set, from sorted (name, value) pairs
+def metric_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in key) + '}'
+
+
+# unpack presentation header and table of (slide_rowid, revision) as found in LiveData, returns offset of whatever follows
+def unpack_presentation(rawdata, offset=0):
+    unknownrawdata0, rev, pres_rowid, title_revision, pres_len, unknownrawdata5 = struct.unpack_from('<lqqqlq', rawdata, offset)
+    slides_end = offset + 40 + (16 * pres_len)
+    if pres_len < 0 or len(rawdata) < slides_end:
+        raise struct.error('slide table of ' + str(pres_len) + ' slides does not fit in ' + str(len(rawdata)) + ' bytes')
+    pres_slides = list(struct.iter_unpack('<qq', rawdata[(offset + 40):slides_end]))
+    return rev, pres_rowid, title_revision, pres_slides, slides_end
+
+
+
+
+
+
+def main():
+    # get/process command-line arguments, one bridge from the command line or each bridge of the config file
+    args = parse_args()
+    bridges_args = parse_config(args.config) if args.config else [(None, args)]
+    log.start(args.log_level)
+    
+    bridges = []
+    for name, bridge_args in bridges_args:
+        token = log.prefix.set('[' + name + '] ' if name else '')
+        bridges.append(Bridge(bridge_args, name))
+        log.prefix.reset(token)
+
+    log.info('EW2VM STARTING (CTRL+C TO TERMINATE)...')
+    
+    metrics_server = None
+    if args.metrics_port:
+        try:
+            metrics_server = MetricsServer(bridges, args.metrics_host, args.metrics_port)
+        except OSError as e:
+            log.warning('Could not serve metrics on ' + args.metrics_host + ' port ' + str(args.metrics_port) + ' (' + str(e) + ').')
+        else:
+            threading.Thread(target=metrics_server.serve_forever, name='metrics_thread', daemon=True).start()
+    
+    for bridge in bridges:
+        token = log.prefix.set(bridge.log_prefix)
+        start_bridge(bridge)
+        log.prefix.reset(token)
+    
+    try:
+        if args.config:
+            run_async(run_supervisor(bridges))
+        elif args.engine == 'asyncio':
+            run_async(run_asyncio(bridges[0]))
+        else:
+            run_threads(bridges[0])
+    except KeyboardInterrupt:
+        log.info('EW2VM TERMINATING...')
+    
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    
+    for bridge in bridges:
+        token = log.prefix.set(bridge.log_prefix)
+        stop_bridge(bridge)
+        log.prefix.reset(token)
+
+    log.info('EW2VM FINISHED.')
+    log.stop()
+
+
+# services of a bridge besides its connections
+def start_bridge(bridge):
+    args = bridge.args
+    if args.publish_port:
+        try:
+            bridge.publisher = Publisher(args.publish_host, args.publish_port)
+        except OSError as e:
+            log.warning('Could not publish slides on ' + args.publish_host + ' port ' + str(args.publish_port) + ' (' + str(e) + ').')
+        else:
+            bridge.publisher.start()
+
+
+def stop_bridge(bridge):
+    if bridge.publisher:
+        bridge.publisher.stop()
+    
+    if bridge.capture:
+        bridge.capture.close()
+    
+    bridge.slide_cache.save()
+    log.info('INFO: ' + str(sum(link.txqueue.coalesced for link in bridge.vm_links)) + ' outdated VM commands were replaced by newer ones before being sent.')
 
 
 
 
 
 
-def main():
-    global args, credit_slide_re, ew_connected, presentation_filter_re, vm_connected
-    ew_rxthread = None
-    ew_socket = None
-    ew_txthread = None
-    vm_rxthread = None
-    vm_socket = None
-    vm_txthread = None
+# get/process command-line arguments of one bridge
+def parse_args(argv=None, prog=None):
+    arg_parser = build_arg_parser(prog)
+    args = arg_parser.parse_args(argv)
+    if args.config and prog:
+        arg_parser.error('--config is not allowed in a config file')
+    if args.vm_input is None and not args.vm_target and not args.config:
+        arg_parser.error('one of the arguments --vm-input --vm-target --config is required')
+    return args
+
 
-    # get/process command-line arguments
-    arg_parser = argparse.ArgumentParser(usage='%(prog)s --vm-input NUM [options] | --help', description='Sends text from EasyWorship presentation/song slides to a vMix Title input using the TCP APIs of both programs.', epilog='EW2VM Copyright (c) 2021 Michael Norton. MIT License; see LICENSE.md file for details.', allow_abbrev=False)
+# bridges of a supervisor config file, a JSON list of {"name": NAME, "args": [ARG, ...]}, as (name, args)
+def parse_config(path):
+    try:
+        with open(path, encoding='utf-8') as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError) as e:
+        sys.exit('ew2vm.py: error: could not read config file ' + path + ' (' + str(e) + ')')
+    if not isinstance(config, list) or not config or not all(isinstance(entry, dict) and isinstance(entry.get('args'), list) for entry in config):
+        sys.exit('ew2vm.py: error: config file ' + path + ' should be a list of {"name": NAME, "args": [ARG, ...]}')
+    
+    bridges_args = []
+    for i, entry in enumerate(config):
+        name = str(entry.get('name', 'bridge ' + str(i + 1)))
+        if any(name == other_name for other_name, other_args in bridges_args):
+            sys.exit('ew2vm.py: error: config file ' + path + ' has more than one bridge named ' + repr(name))
+        bridge_args = parse_args([str(arg) for arg in entry['args']], 'ew2vm.py [' + name + ']')
+        if bridge_args.metrics_port:
+            sys.exit('ew2vm.py: error: --metrics-port of bridge ' + repr(name) + ' belongs on the command line, where it serves the metrics of every bridge')
+        bridges_args.append((name, bridge_args))
+    return bridges_args
+
+
+# command-line arguments of one bridge
+def build_arg_parser(prog=None):
+    arg_parser = argparse.ArgumentParser(prog=prog, usage='%(prog)s --vm-input NUM | --vm-target INPUT@HOST [...] | --config FILE [options] | --help', description='Sends text from EasyWorship presentation/song slides to a vMix Title input using the TCP APIs of both programs.', epilog='EW2VM Copyright (c) 2021 Michael Norton. MIT License; see LICENSE.md file for details.', allow_abbrev=False)
     arg_parser.add_argument('--ew-host', default='::1', metavar='HOST', help='network address where EasyWorship is running (default ::1)')
     arg_parser.add_argument('--ew-client-id', default='a164e834-fc66-4cff-8e47-aa904ee9e62b', metavar='GUID', help='client ID for connection to EasyWorship (e.g. if running multiple instances of %(prog)s simultaneously)')
     arg_parser.add_argument('--vm-host', default='::1', metavar='HOST', help='network address where vMix is running (default ::1)')
-    arg_parser.add_argument('--vm-input', required=True, type=int, metavar='NUM', help='vMix input number')
+    arg_parser.add_argument('--vm-input', type=int, metavar='NUM', help='vMix input number')
     arg_parser.add_argument('--vm-textbox', type=int, default=0, metavar='INDEX', help='textbox on vMix Title in which to place main slide text (default 0)')
     arg_parser.add_argument('--vm-textbox-credit', type=int, default=1, metavar='INDEX', help='textbox on vMix Title in which to place title/credit text (default 1)')
+    arg_parser.add_argument('--vm-target', nargs='+', type=vm_target_arg, metavar='INPUT[,TEXTBOX,TEXTBOX_CREDIT]@HOST', help='send to each of these vMix Title inputs instead of --vm-input on --vm-host, textboxes default to --vm-textbox and --vm-textbox-credit')
+    arg_parser.add_argument('--max-lines', type=int, default=0, metavar='NUM', help='send only the first NUM lines of each slide to vMix (default 0, all lines)')
+    arg_parser.add_argument('--normalize-whitespace', action='store_true', help='remove blank lines and repeated, leading and trailing spaces from text sent to vMix')
+    arg_parser.add_argument('--uppercase', action='store_true', help='send text to vMix in upper case')
     arg_parser.add_argument('--presentation-filter', nargs='+', metavar='TAG', help='only show presentations/songs that contain any slide with any TAG in the slide title')
     arg_parser.add_argument('--credit-slide', nargs='+', default=['Title', 'Credit', 'Credits'], metavar='TAG', help='use the text from slide with any TAG in its title as custom title/credit text for the whole presentation/song (default "Title" "Credit" "Credits")')
-    args = arg_parser.parse_args()
-    
-    if args.presentation_filter:
-        presentation_filter_re = re.compile('(?:\A|\s)(' + '|'.join(args.presentation_filter) + ')(?:\s|\Z)', re.IGNORECASE)
-    
-    if args.credit_slide:
-        credit_slide_re = re.compile('(?:\A|\s)(' + '|'.join(args.credit_slide) + ')(?:\s|\Z)', re.IGNORECASE)
-    else:
-        credit_slide_re = re.compile('\Z.')
+    arg_parser.add_argument('--progressive', action='store_true', help='send the live slide as soon as its text is retrieved instead of waiting for every slide of the presentation/song, updating title/credit text as the other slides arrive')
+    arg_parser.add_argument('--prefetch', type=int, default=0, metavar='NUM', help='experimental: retrieve slides of the next NUM presentations/songs in the EasyWorship schedule in the background, so they are ready when they go live (default 0)')
+    arg_parser.add_argument('--prefetch-rate', type=float, default=10, metavar='NUM', help='retrieve at most NUM slides per second in the background when prefetching (default 10)')
+    arg_parser.add_argument('--slideinfo-window', type=int, default=8, metavar='NUM', help='send at most NUM slide info requests to EasyWorship before waiting for answers, fewer while it is slow to answer (default 8)')
+    arg_parser.add_argument('--slideinfo-timeout', type=float, default=2, metavar='SECONDS', help='request slide info again if EasyWorship has not answered within SECONDS (default 2)')
+    arg_parser.add_argument('--slide-cache-size', type=int, default=10000, metavar='NUM', help='remember the text of up to NUM slides so presentations shown before need no slide info requests, 0 to disable (default 10000)')
+    arg_parser.add_argument('--slide-cache-file', metavar='FILE', help='keep the slide cache in FILE so it survives restarts')
+    arg_parser.add_argument('--image-dir', metavar='DIR', help='save the image of each live slide in DIR, once per distinct image, and show it on --vm-image-input')
+    arg_parser.add_argument('--vm-image-input', type=int, metavar='NUM', help='vMix Title input on which to show the live slide image saved in --image-dir')
+    arg_parser.add_argument('--image-timeout', type=float, default=5, metavar='SECONDS', help='give up on the image of a slide if EasyWorship has not started sending it within SECONDS (default 5)')
+    arg_parser.add_argument('--vm-image-index', type=int, default=0, metavar='INDEX', help='image on vMix Title in which to show the live slide image (default 0)')
+    arg_parser.add_argument('--vm-min-interval', type=float, default=0, metavar='SECONDS', help='send updates to vMix at most once per SECONDS, skipping any intermediate slides (default 0)')
+    arg_parser.add_argument('--vm-state-interval', type=float, default=0, metavar='SECONDS', help='also read back what vMix shows every SECONDS, to correct manual edits sooner (default 0, only after connecting and when vMix reports activity)')
+    arg_parser.add_argument('--vm-ignore-activity', action='store_true', help='do not read back what vMix shows when it reports activity on a target input or a command that failed, only after connecting and every --vm-state-interval')
+    arg_parser.add_argument('--ew-deadline', type=float, default=10, metavar='SECONDS', help='reconnect to EasyWorship if it has sent nothing for SECONDS, not even an answer to the heartbeat sent after 3 seconds without traffic (once it has answered one), and have TCP keepalive check it within about SECONDS, 0 to disable (default 10)')
+    arg_parser.add_argument('--vm-deadline', type=float, default=10, metavar='SECONDS', help='probe vMix once it has sent nothing for a third of SECONDS, and reconnect if it has still sent nothing after SECONDS, also checked by TCP keepalive, 0 to disable (default 10)')
+    arg_parser.add_argument('--metrics-port', type=int, metavar='PORT', help='serve latency, queue and connection metrics in Prometheus text format at http://HOST:PORT/metrics, and connection health at http://HOST:PORT/healthz')
+    arg_parser.add_argument('--metrics-host', default='::1', metavar='HOST', help='network address to serve metrics on (default ::1)')
+    arg_parser.add_argument('--publish-port', type=int, metavar='PORT', help='serve the title, credit, slide text and visibility sent to vMix to any number of local subscribers as JSON lines on TCP port PORT')
+    arg_parser.add_argument('--publish-host', default='::1', metavar='HOST', help='network address to serve subscribers on (default ::1)')
+    arg_parser.add_argument('--capture', metavar='FILE', help='record everything sent to and received from EasyWorship and vMix in FILE, for replaying with ew2vm_replay.py')
+    arg_parser.add_argument('--log-level', choices=['quiet', 'info', 'wire'], default='info', help='show only warnings, also connection and presentation events, or also every message sent and received (default info)')
+    arg_parser.add_argument('--config', metavar='FILE', help='run every bridge listed in FILE (a JSON list of {"name": NAME, "args": [ARG, ...]}) in this one process, on a single asyncio event loop; --log-level, --metrics-port and --metrics-host apply to all of them')
+    arg_parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='run each connection on its own transmit and receive threads, or run both connections on a single asyncio event loop (default threads)')
+    return arg_parser
+
+
+
+
+
+
+# value of --vm-target, INPUT[,TEXTBOX,TEXTBOX_CREDIT]@HOST
+def vm_target_arg(spec):
+    match = re.fullmatch('([0-9]+)(?:,([0-9]+),([0-9]+))?@(.+)', spec)
+    if not match:
+        raise argparse.ArgumentTypeError('expected INPUT@HOST or INPUT,TEXTBOX,TEXTBOX_CREDIT@HOST, not ' + repr(spec))
+    return match.group(4), int(match.group(1)), (int(match.group(2)) if match.group(2) else None), (int(match.group(3)) if match.group(3) else None)
+
+
+
+
+
+
+# resolver for querying the IP of ew for mdns records, its nameservers are set by ew_nameservers before each search
+def ew_resolver_config(resolver):
+    resolver.port = 5353
+    # ew answers within milliseconds if it is there at all, rather retry soon than wait long
+    resolver.timeout = 1
+    resolver.lifetime = 2
+    return resolver
+
+
+# IP of ew from getaddrinfo results (blocking socket.getaddrinfo or the event loop's), so we can query the IP for mdns records with dns.resolver
+def ew_nameservers(addrinfos):
+    return [addrinfo[4][0] for addrinfo in addrinfos]
+
+
+# dynamic EW port from mdns records (new in EW 7.2.3)
+def ew_resolution_port(ew_resolution):
+    ew_srv_name = ew_resolution.rrset[0].target
+    return ew_resolution.response.find_rrset(dns.message.ADDITIONAL, ew_srv_name, dns.rdataclass.IN, dns.rdatatype.SRV)[0].port
+
+
+
+
 
-    print('\33[91mEW2VM STARTING (CTRL+C TO TERMINATE)...\033[0m')
+
+# threaded engine: main loop, infinitely attempt connections to ew (and to each vm on its own thread)
+def run_threads(bridge):
+    args = bridge.args
+    ew_rxthread = None
+    ew_socket = None
+    ew_txthread = None
     
-    # resolve IP of ew with getaddrinfo so we can query the IP for mdns records with dns.resolver
-    ew_resolver = dns.resolver.Resolver(configure=False)
-    ew_resolver.nameservers = [addrinfo[4][0] for addrinfo in socket.getaddrinfo(args.ew_host, 5353, proto=socket.IPPROTO_UDP)]
-    ew_resolver.port = 5353
-    ew_resolver.timeout = 3
+    ew_resolver = ew_resolver_config(dns.resolver.Resolver(configure=False))
     
+    stopping = threading.Event()
+    vm_linkthreads = [threading.Thread(target=run_vm_link, name='vm_linkthread', args=(bridge, link, stopping)) for link in bridge.vm_links]
+    for vm_linkthread in vm_linkthreads:
+        vm_linkthread.start()
+    
+    ew_retrytimestamp = 0
     try:
-        # main loop, infinitely attempt connections to ew and vm
         while True:
-            
-            # connect to vm
-            if not vm_connected:
-                print('\33[91mNot connected to VM.\033[0m')
+
+            # connect to ew
+            if not bridge.ew_connected and time.monotonic() >= ew_retrytimestamp:
+                log.info('Not connected to EW.')
                 
                 # clean up any existing connection
-                disconnect(vm_socket, vm_txthread, vm_rxthread, 'VM')
-                              
-                try:
-                    # open new socket
-                    print('\33[91mConnecting to VM at ' + args.vm_host + ' port 8099...\033[0m')
-                    vm_socket = socket.create_connection((args.vm_host, 8099), 7)
-                except OSError:
-                    vm_socket = None
-                    print('\33[91mConnecting to VM failed!\033[0m')
+                disconnect(ew_socket, ew_txthread, ew_rxthread, bridge.ew_txqueue, 'EW')
+                ew_socket = None
+                
+                # ew usually comes back on the same port, try that before searching for it
+                if bridge.ew_port is not None:
+                    try:
+                        log.info('Connecting to EW at ' + args.ew_host + ' port ' + str(bridge.ew_port) + '...')
+                        ew_socket = socket.create_connection((args.ew_host, bridge.ew_port), 3)
+                    except OSError:
+                        bridge.ew_port = None
+                
+                if ew_socket is None:
+                    try:
+                        # resolve IP of ew on every search, a host name that does not resolve (yet) is retried like EW not being there
+                        try:
+                            ew_resolver.nameservers = ew_nameservers(socket.getaddrinfo(args.ew_host, 5353, proto=socket.IPPROTO_UDP))
+                        except OSError as e:
+                            log.warning('Could not resolve EW host ' + args.ew_host + ' (' + str(e) + ').')
+                            raise
+                        
+                        # resolve mdns records to determine dynamic EW port (new in EW 7.2.3)
+                        log.info('Searching for EW on ' + str(ew_resolver.nameservers) + '...')
+                        ew_port = ew_resolution_port(ew_resolver.resolve('_ezwremote._tcp.local.', rdtype=dns.rdatatype.PTR))
+                    
+                        # open new socket
+                        log.info('Connecting to EW at ' + args.ew_host + ' port ' + str(ew_port) + '...')
+                        ew_socket = socket.create_connection((args.ew_host, ew_port), 3)
+                    except (OSError, dns.exception.Timeout, dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                        ew_socket = None
+                    else:
+                        bridge.ew_port = ew_port
+                
+                if ew_socket is None:
+                    ew_retrydelay = bridge.ew_backoff.next()
+                    ew_retrytimestamp = time.monotonic() + ew_retrydelay
+                    log.info('Connecting to EW failed! Retrying in ' + str(round(ew_retrydelay, 1)) + ' s.')
                 else:
-                    print('\33[91mConnected to VM.\033[0m')
-                    vm_connected = True
+                    log.info('Connected to EW.')
+                    set_keepalive(ew_socket, args.ew_deadline)
+                    bridge.ew_backoff.reset()
+                    bridge.ew_connected = True
+                    bridge.record_connect('ew', args.ew_host)
                     
                     # flush tx message queue
-                    vm_txqueue.clear()
+                    bridge.ew_txqueue.reopen()
+                    bridge.ew_wakeup.clear()
                     
                     # start communication threads
-                    vm_txthread = threading.Thread(target=send_vm, name='vm_txthread', args=([vm_socket]))
-                    vm_txthread.start()
-                    vm_rxthread = threading.Thread(target=recv_vm, name='vm_rxthread', args=([vm_socket]))
-                    vm_rxthread.start()
+                    ew_txthread = threading.Thread(target=send_ew, name='ew_txthread', args=(bridge, ew_socket))
+                    ew_txthread.start()
+                    ew_rxthread = threading.Thread(target=recv_ew, name='ew_rxthread', args=(bridge, ew_socket))
+                    ew_rxthread.start()
 
-            # connect to ew
-            if not ew_connected:
-                print('\33[91mNot connected to EW.\033[0m')
+                    with bridge.lock:
+                        bridge.ew_hello()
+
+            # tick bridge timers, waking up early when the ew connection drops
+            if bridge.ew_wakeup.wait(0.1):
+                bridge.ew_wakeup.clear()
+            with bridge.lock:
+                bridge.tick()
+        
+    finally:
+        stopping.set()
+        for link in bridge.vm_links:
+            link.wakeup.set()
+        for vm_linkthread in vm_linkthreads:
+            vm_linkthread.join()
+        bridge.ew_connected = False
+        disconnect(ew_socket, ew_txthread, ew_rxthread, bridge.ew_txqueue, 'EW')
+
+
+
+
+
+
+# threaded engine: infinitely attempt connection to one vm, independently of the others
+def run_vm_link(bridge, link, stopping):
+    vm_rxthread = None
+    vm_socket = None
+    vm_txthread = None
+    
+    try:
+        while not stopping.is_set():
+            vm_retrydelay = None
+            
+            # connect to vm
+            if not link.connected:
+                log.info('Not connected to VM at ' + link.host + '.')
                 
                 # clean up any existing connection
-                disconnect(ew_socket, ew_txthread, ew_rxthread, 'EW')
-                
+                disconnect(vm_socket, vm_txthread, vm_rxthread, link.txqueue, 'VM at ' + link.host)
+                              
                 try:
-                    # resolve mdns records to determine dynamic EW port (new in EW 7.2.3)
-                    print('\33[91mSearching for EW on ' + str(ew_resolver.nameservers) + '...\033[0m')
-                    ew_resolution = ew_resolver.resolve('_ezwremote._tcp.local.', rdtype=dns.rdatatype.PTR)
-                    ew_srv_name = ew_resolution.rrset[0].target
-                    ew_port = ew_resolution.response.find_rrset(dns.message.ADDITIONAL, ew_srv_name, dns.rdataclass.IN, dns.rdatatype.SRV)[0].port
-                
                     # open new socket
-                    print('\33[91mConnecting to EW at ' + args.ew_host + ' port ' + str(ew_port) + '...\033[0m')
-                    ew_socket = socket.create_connection((args.ew_host, ew_port), 7)
-                except (OSError, dns.exception.Timeout, dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-                    ew_socket = None
-                    print('\33[91mConnecting to EW failed!\033[0m')
+                    log.info('Connecting to VM at ' + link.host + ' port 8099...')
+                    vm_socket = socket.create_connection((link.host, 8099), 3)
+                except OSError:
+                    vm_socket = None
+                    vm_retrydelay = link.backoff.next()
+                    log.info('Connecting to VM at ' + link.host + ' failed! Retrying in ' + str(round(vm_retrydelay, 1)) + ' s.')
                 else:
-                    print('\33[91mConnected to EW.\033[0m')
-                    ew_connected = True
+                    log.info('Connected to VM at ' + link.host + '.')
+                    set_keepalive(vm_socket, bridge.args.vm_deadline)
+                    link.backoff.reset()
+                    link.connected = True
+                    bridge.record_connect('vm', link.host)
                     
-                    # flush tx message queue
-                    ew_txqueue.clear()
+                    # flush tx message queue, then find out what vm shows
+                    link.txqueue.reopen()
+                    link.wakeup.clear()
+                    with bridge.lock:
+                        bridge.vm_connected(link)
                     
                     # start communication threads
-                    ew_txthread = threading.Thread(target=send_ew, name='ew_txthread', args=([ew_socket]))
-                    ew_txthread.start()
-                    ew_rxthread = threading.Thread(target=recv_ew, name='ew_rxthread', args=([ew_socket]))
-                    ew_rxthread.start()
-
-                    # hello to ew
-                    ew_txqueue.append(('{"device_type":0,"action":"connect","uid":"' + args.ew_client_id + '","device_name":"ew2vm (Input ' + str(args.vm_input) + ' @ ' + args.vm_host + ')"}\r\n').encode('utf-8'))
-
-            # main loop is loop
-            time.sleep(2)
+                    vm_txthread = threading.Thread(target=send_vm, name='vm_txthread', args=(bridge, link, vm_socket))
+                    vm_txthread.start()
+                    vm_rxthread = threading.Thread(target=recv_vm, name='vm_rxthread', args=(bridge, link, vm_socket))
+                    vm_rxthread.start()
             
-    except KeyboardInterrupt:
-        print('\33[91mEW2VM TERMINATING...\033[0m')
-        
+            # sleep until the connection drops (or it is time to retry)
+            link.wakeup.wait(vm_retrydelay)
+            link.wakeup.clear()
+    
     finally:
-        vm_connected = False
-        disconnect(vm_socket, vm_txthread, vm_rxthread, 'VM')
-        ew_connected = False
-        disconnect(ew_socket, ew_txthread, ew_rxthread, 'EW')
+        link.connected = False
+        disconnect(vm_socket, vm_txthread, vm_rxthread, link.txqueue, 'VM at ' + link.host)
+
 
-    print('\33[91mEW2VM FINISHED.\033[0m')
 
 
 
 
+# let the os notice a dead peer within about deadline seconds, whether or not the peer answers anything: keepalive probes once the
+# connection is idle, and (where supported) a limit on how long sent data may go unacknowledged, as it does not while heartbeats are pending
+def set_keepalive(thesocket, deadline):
+    if thesocket is None or deadline <= 0:
+        return
+    idle = max(1, int(deadline / 3))
+    interval = max(1, int(deadline / 6))
+    try:
+        thesocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            thesocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, 'TCP_KEEPALIVE'): # macOS
+            thesocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL') and hasattr(socket, 'TCP_KEEPCNT'):
+            thesocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            thesocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+        elif hasattr(socket, 'SIO_KEEPALIVE_VALS') and hasattr(thesocket, 'ioctl'): # older windows
+            thesocket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+        if hasattr(socket, 'TCP_USER_TIMEOUT'): # linux
+            thesocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(deadline * 1000))
+    except OSError as e:
+        log.info('INFO: Could not set TCP keepalive (' + str(e) + ').')
 
 
 # close and cleanup TCP connection with ew/vm
-def disconnect(thesocket=None, txthread=None, rxthread=None, description='something'):    
+def disconnect(thesocket=None, txthread=None, rxthread=None, txqueue=None, description='something'):
     if thesocket:
         # close existing socket if applicable
-        print('\33[91mClosing connection to ' + description + '...\033[0m')
+        log.info('Closing connection to ' + description + '...')
         try:
             thesocket.settimeout(0)
         except OSError:
@@ -214,14 +2240,18 @@ def disconnect(thesocket=None, txthread=None, rxthread=None, description='someth
         except OSError:
             pass
     
+    # wake transmit thread if it is waiting on an empty queue
+    if txqueue is not None:
+        txqueue.close()
+    
     # wait for communication threads to die if applicable
     if txthread:
         if txthread.is_alive():
-            print('\33[91mWaiting for ' + description + ' transmit to finish...\033[0m')
+            log.info('Waiting for ' + description + ' transmit to finish...')
             txthread.join()
     if rxthread:
         if rxthread.is_alive():
-            print('\33[91mWaiting for ' + description + ' receive to finish...\033[0m')
+            log.info('Waiting for ' + description + ' receive to finish...')
             rxthread.join()
 
 
@@ -229,151 +2259,359 @@ def disconnect(thesocket=None, txthread=None, rxthread=None, description='someth
 
 
 
-# process received ew message
-def procmsg_ew(jsondata, rawdata):
-    global content_sent, contentvisible, contentvisible_pending, credit, credit_sent, imagehash, imagehash_pending, liverev, liverev_pending, pres_rowid, presentation_filtered, requestrev, slide_rowid_pending, slides, title
+# split received vm data into messages and process them, the decoder keeping any incomplete message for next time
+def frame_vm(bridge, link, decoder, newdata):
+    for message, payload in decoder.feed(newdata):
+        # parse state before taking the lock, the XML of a large vmix project takes a while and ew should not wait for it
+        vmix = parse_vm_state(link, message, payload)
+        # process received message
+        with bridge.lock:
+            bridge.procmsg_vm(link, message, vmix)
+
+
+# XML state of vm from the payload of an XML message, None for any other message or if it can't be parsed
+def parse_vm_state(link, message, payload):
+    if not message.startswith(b'XML ') or not payload:
+        return None
+    try:
+        return xml.etree.ElementTree.fromstring(payload)
+    except xml.etree.ElementTree.ParseError as e:
+        log.warning('Could not parse state of VM at ' + link.host + ' (' + str(e) + ').')
+        return None
+
+
+
+
+
+
+# receive ew communications
+def recv_ew(bridge, ew_socket):
+    decoder = EWFrameDecoder(bridge.image_sink if bridge.image_store else None)
     
-    if 'requestrev' in jsondata:
-        requestrev = int(jsondata['requestrev'])
+    while bridge.ew_connected:
+        try:
+            ew_socket.settimeout(None)
+            # receive data from socket
+            newdata = ew_socket.recv(16384)
+        except OSError:
+            bridge.ew_connected = False
+        else:
+            if len(newdata) < 1:
+                bridge.ew_connected = False
+            bridge.record_io('ew', bridge.args.ew_host, 'rx', newdata)
+            received = time.monotonic()
+            bridge.ew_heard = received
+            for jsondata, rawdata in decoder.feed(newdata):
+                # process received message
+                with bridge.lock:
+                    bridge.ew_received = received
+                    bridge.procmsg_ew(jsondata, rawdata)
+    
+    bridge.ew_wakeup.set()
 
-    if 'action' in jsondata:
-                    
-        if jsondata['action'] == 'status':                
-            if 'liverev' in jsondata:
-                liverev_pending = int(jsondata['liverev'])
-            if 'imagehash' in jsondata:
-                imagehash_pending = jsondata['imagehash']
-                slide_rowid_pending = int(jsondata.get('slide_rowid', -1))
-            if True in [bool(jsondata.get('logo', False)), bool(jsondata.get('black', False)), bool(jsondata.get('clear', False))]:
-                contentvisible_pending = False
+
+
+
+
+
+# receive vm communications
+def recv_vm(bridge, link, vm_socket):
+    decoder = VMFrameDecoder()
+    
+    while link.connected:
+        try:
+            vm_socket.settimeout(None)
+            # receive data from socket
+            newdata = vm_socket.recv(2048)
+        except OSError:
+            link.connected = False
+        else:
+            if len(newdata) < 1:
+                link.connected = False
+            bridge.record_io('vm', link.host, 'rx', newdata)
+            link.heard = time.monotonic()
+            frame_vm(bridge, link, decoder, newdata)
+    
+    link.wakeup.set()
+
+
+
+
+
+
+# send ew communication from outgoing message queue
+def send_ew(bridge, ew_socket):
+    heartbeattimestamp = time.monotonic() + 3
+    
+    while bridge.ew_connected:
+        # sleep until a message is queued or it is time for the keepalive
+        outboundbytes = bridge.ew_txqueue.popall(max(0, heartbeattimestamp - time.monotonic()))
+        if len(outboundbytes) < 1 and bridge.ew_connected and time.monotonic() >= heartbeattimestamp:
+            # more than 3 seconds since last transmission, so transmit keepalive
+            outboundbytes = bridge.ew_heartbeat()
+        elif outboundbytes:
+            bridge.metrics.observe('ew2vm_batch_messages', bridge.ew_txqueue.batch, link='ew', host=bridge.args.ew_host)
+        sentbytecount_total = 0
+        while sentbytecount_total < len(outboundbytes):
+            try:
+                ew_socket.settimeout(7)
+                sentbytecount = ew_socket.send(outboundbytes[sentbytecount_total:])
+                ew_socket.settimeout(None)
+            except OSError:
+                bridge.ew_connected = False
+                outboundbytes = b''
             else:
-                contentvisible_pending = True
+                if sentbytecount < 1:
+                    bridge.ew_connected = False
+                    outboundbytes = b''
+                else:
+                    heartbeattimestamp = time.monotonic() + 3
+                    sentbytes = outboundbytes[sentbytecount_total:sentbytecount_total + sentbytecount]
+                    bridge.record_io('ew', bridge.args.ew_host, 'tx', sentbytes)
+                    log.wire('SEND-EW', '95', sentbytes)
+                    sentbytecount_total += sentbytecount
+    
+    bridge.ew_wakeup.set()
 
 
-        elif jsondata['action'] == 'LiveData':
-            
-            # clear stored slides
-            credit = ''
-            presentation_filtered = True
-            slides = {}
-            title = ''
-            
-            # unpack first part of raw data
-            unknownrawdata0, liverev, pres_rowid, title_revision, pres_len, unknownrawdata5 = struct.unpack('<lqqqlq', rawdata[:40])
-            #print((unknownrawdata0, liverev, pres_rowid, title_revision, pres_len, unknownrawdata5))
-                        
-            # request title info
-            ew_txqueue.append(('{"slide_rowid":0,"revision":' + str(title_revision) + ',"action":"getSlideInfo","requestrev":' + str(requestrev) + ',"rectype":1,"pres_rowid":' + str(pres_rowid) + '}\r\n').encode('utf-8'))
-            
-            # store preliminary info of each slide
-            for i in range(pres_len):
-                slide = {}
-                slide['id'] = i
-                slide['slide_rowid'], slide['revision'] = struct.unpack('<qq', rawdata[(40 + (16 * i)):(56 + (16 * i))])
-                slide['infoReceived'] = False
-                slide['infoRequested'] = False
-                slides[slide['slide_rowid']] = slide
-                                              
-
-        elif jsondata['action'] == 'slideInfo' and 'slide_rowid' in jsondata:
-            
-            if int(jsondata['slide_rowid']) == 0: # slide 0 info is for the song title (not for an actual slide)
-                if 'title' in jsondata:
-                    title = jsondata['title']
-                    
-            if int(jsondata['slide_rowid']) in slides: # info is for a valid slide
-                
-                if credit_slide_re.search(jsondata.get('title', '')): # slide is a special slide of custom song credits
-                    credit = jsondata.get('content', '')
-                    # store blank lyrics for this slide
-                    slides[int(jsondata['slide_rowid'])]['content'] = ''
-                    
-                else: # info is for regular slide
-                    if 'content' in jsondata:
-                        slides[int(jsondata['slide_rowid'])]['content'] = jsondata['content']
-                    if 'title' in jsondata:
-                        slides[int(jsondata['slide_rowid'])]['title'] = jsondata['title']
-                        
-                slides[int(jsondata['slide_rowid'])]['infoReceived'] = True
-                
-                if not presentation_filter_re: # presentation filtering is not enabled
-                    presentation_filtered = False
+
+
+
+
+# send vm communication from outgoing message queue
+def send_vm(bridge, link, vm_socket):
+    
+    while link.connected:
+        # sleep until a message is queued
+        outboundbytes = link.txqueue.popall()
+        stamp = link.txqueue.sent_stamp
+        if outboundbytes:
+            bridge.metrics.observe('ew2vm_batch_messages', link.txqueue.batch, link='vm', host=link.host)
+        sentbytecount_total = 0
+        while sentbytecount_total < len(outboundbytes):
+            try:
+                vm_socket.settimeout(7)
+                sentbytecount = vm_socket.send(outboundbytes[sentbytecount_total:])
+                vm_socket.settimeout(None)
+            except OSError:
+                link.connected = False
+                outboundbytes = b''
+            else:
+                if sentbytecount < 1:
+                    link.connected = False
+                    outboundbytes = b''
                 else:
-                    if presentation_filter_re.search(jsondata.get('title', '')): # slide title matches filter
-                        presentation_filtered = False
+                    sentbytes = outboundbytes[sentbytecount_total:sentbytecount_total + sentbytecount]
+                    bridge.record_io('vm', link.host, 'tx', sentbytes)
+                    log.wire('SEND-VM', '93', sentbytes)
+                    sentbytecount_total += sentbytecount
+        if stamp is not None and outboundbytes:
+            bridge.metrics.observe('ew2vm_slide_latency_seconds', time.monotonic() - stamp, host=link.host)
     
+    link.wakeup.set()
+
+
+
+
+
+
+# supervisor mode: every bridge of the config file on the same event loop, tasks of each tagging their log lines with its name
+async def run_supervisor(bridges):
+    tasks = []
+    for bridge in bridges:
+        token = log.prefix.set(bridge.log_prefix)
+        tasks.append(asyncio.ensure_future(run_bridge_async(bridge)))
+        tasks.append(asyncio.ensure_future(run_status_async(bridge)))
+        log.prefix.reset(token)
+    await run_tasks_async(tasks)
+
+
+# run one bridge, restarting it if it fails so a bad room never takes down the others
+async def run_bridge_async(bridge):
+    while True:
+        try:
+            await run_asyncio(bridge)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning('Bridge failed (' + repr(e) + ')! Restarting in 5 s.')
+            await asyncio.sleep(5)
+
+
+# show status line of a bridge whenever it changes
+async def run_status_async(bridge):
+    status = None
+    while True:
+        if bridge.status_line() != status:
+            status = bridge.status_line()
+            log.info('STATUS: ' + status)
+        await asyncio.sleep(1)
+
+
+
+
+
+
+# asyncio engine: both connections as streams on one event loop
+async def run_asyncio(bridge):
+    await run_tasks_async([asyncio.ensure_future(coroutine) for coroutine in [run_ew_async(bridge), run_ticks_async(bridge)] + [run_vm_async(bridge, link) for link in bridge.vm_links]])
+
+
+# wait for tasks that should run forever, once one fails (or we are cancelled) cancel the rest and wait for them to close their connections
+async def run_tasks_async(tasks):
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# asyncio.run, but on CTRL+C the coroutine is cancelled and awaited while the loop still runs, so every connection is closed before the loop is
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    main_task = loop.create_task(coroutine)
+    try:
+        loop.run_until_complete(main_task)
+    finally:
+        main_task.cancel()
+        loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
+        # whatever is left escaped its owner, e.g. when CTRL+C interrupted the owner rather than the task itself
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+
+
+
+
+# tick bridge timers
+async def run_ticks_async(bridge):
+    while True:
+        await asyncio.sleep(0.1)
+        bridge.tick()
+
+
+
+
+
+
+# infinitely attempt connection to ew, reconnecting as soon as the connection drops
+async def run_ew_async(bridge):
+    args = bridge.args
+    ew_resolver = ew_resolver_config(dns.asyncresolver.Resolver(configure=False))
+    loop = asyncio.get_running_loop()
     
-    if contentvisible_pending: # content should be visible
+    while True:
+        log.info('Not connected to EW.')
+        ew_reader = None
         
-        if imagehash_pending != imagehash: # outdated content is currently output
-            
-            if liverev_pending != liverev: # outdated slides are currently loaded
-                # invalidate queued outbound requests
-                ew_txqueue.clear()
-                # clear stored slides
-                credit = ''
-                presentation_filtered = True
-                slides = {}
-                title = ''
-                # request data about new song
-                ew_txqueue.append(('{"action":"GetLiveData","requestrev":' + str(requestrev) + '}\r\n').encode('utf-8'))
-            
-            else:
-                # make sure all slides are loaded
-                waiting_for_slideinfo = False
-                for slide_rowid in slides:
-                    if not slides[slide_rowid].get('infoRequested', False):
-                        # request more info of slide
-                        ew_txqueue.append(('{"slide_rowid":' + str(slide_rowid) + ',"revision":' + str(slides[slide_rowid]['revision']) + ',"action":"getSlideInfo","requestrev":' + str(requestrev) + ',"rectype":1,"pres_rowid":' + str(pres_rowid) + '}\r\n').encode('utf-8'))
-                        slides[slide_rowid]['infoRequested'] = True
-                    if not slides[slide_rowid].get('infoReceived', False):
-                        waiting_for_slideinfo = True
-                    
-                if not waiting_for_slideinfo and slide_rowid_pending in slides:
-                    if presentation_filtered:
-                        print('\33[91mINFO: Presentation ignored by filter ("' + '" or "'.join(args.presentation_filter) + '").\033[0m')
-                        contentvisible_pending = False
-                    else:
-                        if 'content' in slides[slide_rowid_pending]: # we have the content of the new slide
-                            content_new = slides[slide_rowid_pending]['content']
-                            # send content to vm
-                            if content_sent != content_new:
-                                vm_txqueue.append(('FUNCTION SetText Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox) + '&Value=' + urllib.parse.quote(content_new) + '\r\n').encode('utf-8'))
-                                content_sent = content_new
-                            # check if we have custom credit text to send, otherwise use song title
-                            if credit != '':
-                                credit_new = credit
-                            else:
-                                print('\33[91mINFO: No custom credit slide ("' + '" or "'.join(args.credit_slide) + '") loaded, resorting to title.\033[0m')
-                                credit_new = title
-                            # send credit/title to vm
-                            if credit_sent != credit_new:
-                                vm_txqueue.append(('FUNCTION SetText Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox_credit) + '&Value=' + urllib.parse.quote(credit_new) + '\r\n').encode('utf-8'))
-                                credit_sent = credit_new
-
-                            imagehash = imagehash_pending
-                            
-        if imagehash_pending == imagehash: # correct content is currently output
-            if not contentvisible: # content should be visible but is currently hidden
-                # send unhide commands to vm
-                vm_txqueue.append(('FUNCTION SetTextVisibleOn Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox) + '\r\n').encode('utf-8'))
-                vm_txqueue.append(('FUNCTION SetTextVisibleOn Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox_credit) + '\r\n').encode('utf-8'))
-                contentvisible = True
+        # ew usually comes back on the same port, try that before searching for it
+        if bridge.ew_port is not None:
+            try:
+                log.info('Connecting to EW at ' + args.ew_host + ' port ' + str(bridge.ew_port) + '...')
+                ew_reader, ew_writer = await asyncio.wait_for(asyncio.open_connection(args.ew_host, bridge.ew_port), 3)
+            except (OSError, asyncio.TimeoutError):
+                bridge.ew_port = None
+        
+        if ew_reader is None:
+            try:
+                # resolve IP of ew on every search without blocking the loop, a host name that does not resolve (yet) is retried like EW not being there
+                try:
+                    ew_resolver.nameservers = ew_nameservers(await loop.getaddrinfo(args.ew_host, 5353, proto=socket.IPPROTO_UDP))
+                except OSError as e:
+                    log.warning('Could not resolve EW host ' + args.ew_host + ' (' + str(e) + ').')
+                    raise
                 
-    if (not contentvisible_pending) and contentvisible: # content should be hidden but is currently visible
-        # send hide commands to vm
-        vm_txqueue.append(('FUNCTION SetTextVisibleOff Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox) + '\r\n').encode('utf-8'))
-        vm_txqueue.append(('FUNCTION SetTextVisibleOff Input=' + str(args.vm_input) + '&SelectedIndex=' + str(args.vm_textbox_credit) + '\r\n').encode('utf-8'))
-        contentvisible = False
+                # resolve mdns records to determine dynamic EW port (new in EW 7.2.3)
+                log.info('Searching for EW on ' + str(ew_resolver.nameservers) + '...')
+                ew_port = ew_resolution_port(await ew_resolver.resolve('_ezwremote._tcp.local.', rdtype=dns.rdatatype.PTR))
+                
+                # open new stream
+                log.info('Connecting to EW at ' + args.ew_host + ' port ' + str(ew_port) + '...')
+                ew_reader, ew_writer = await asyncio.wait_for(asyncio.open_connection(args.ew_host, ew_port), 3)
+            except (OSError, asyncio.TimeoutError, dns.exception.Timeout, dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                ew_retrydelay = bridge.ew_backoff.next()
+                log.info('Connecting to EW failed! Retrying in ' + str(round(ew_retrydelay, 1)) + ' s.')
+                await asyncio.sleep(ew_retrydelay)
+                continue
+            bridge.ew_port = ew_port
+        
+        log.info('Connected to EW.')
+        set_keepalive(ew_writer.get_extra_info('socket'), args.ew_deadline)
+        bridge.ew_backoff.reset()
+        bridge.ew_connected = True
+        bridge.record_connect('ew', args.ew_host)
+        bridge.ew_txqueue.reopen()
+        bridge.ew_hello()
+        try:
+            await run_link_async(recv_ew_async(bridge, ew_reader), send_ew_async(bridge, ew_writer), watch_link_async(lambda: bridge.ew_connected))
+        finally:
+            bridge.ew_connected = False
+            log.info('Closing connection to EW...')
+            ew_writer.close()
+
+
+
+
+
+
+# infinitely attempt connection to one vm, reconnecting as soon as the connection drops
+async def run_vm_async(bridge, link):
+    
+    while True:
+        log.info('Not connected to VM at ' + link.host + '.')
+        try:
+            # open new stream
+            log.info('Connecting to VM at ' + link.host + ' port 8099...')
+            vm_reader, vm_writer = await asyncio.wait_for(asyncio.open_connection(link.host, 8099), 3)
+        except (OSError, asyncio.TimeoutError):
+            vm_retrydelay = link.backoff.next()
+            log.info('Connecting to VM at ' + link.host + ' failed! Retrying in ' + str(round(vm_retrydelay, 1)) + ' s.')
+            await asyncio.sleep(vm_retrydelay)
+            continue
+        
+        log.info('Connected to VM at ' + link.host + '.')
+        set_keepalive(vm_writer.get_extra_info('socket'), bridge.args.vm_deadline)
+        link.backoff.reset()
+        link.connected = True
+        bridge.record_connect('vm', link.host)
+        link.txqueue.reopen()
+        bridge.vm_connected(link)
+        try:
+            await run_link_async(recv_vm_async(bridge, link, vm_reader), send_vm_async(bridge, link, vm_writer), watch_link_async(lambda: link.connected))
+        finally:
+            link.connected = False
+            log.info('Closing connection to VM at ' + link.host + '...')
+            vm_writer.close()
+
 
 
 
 
 
+# run receive and transmit coroutines of one connection until either one ends, then cancel the other
+async def run_link_async(*coroutines):
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-# process received vm message
-def procmsg_vm(message):
-    pass # meh
+
+# end once the bridge marks the connection down, e.g. for going silent past its deadline
+async def watch_link_async(connected):
+    while connected():
+        await asyncio.sleep(0.1)
 
 
 
@@ -381,83 +2619,42 @@ def procmsg_vm(message):
 
 
 # receive ew communications
-def recv_ew(ew_socket):
-    global ew_connected
-    received_data = b''
-    extrabytes_len = 0
-    newjson = {}
-    newjson_len = -1
-    
-    while ew_connected:
+async def recv_ew_async(bridge, ew_reader):
+    decoder = EWFrameDecoder(bridge.image_sink if bridge.image_store else None)
+    
+    while True:
         try:
-            ew_socket.settimeout(None)
-            # receive data from socket
-            received_data += ew_socket.recv(16384)
+            newdata = await ew_reader.read(16384)
         except OSError:
-            ew_connected = False
-        else:
-            if len(received_data) < 1:
-                ew_connected = False
-        finally:
-            # find first message delimiter
-            newjson_len = received_data.find(b'\r\n')
-            while newjson_len != -1:
-                
-                print('RECV-EW: \33[94m' + received_data[:newjson_len].decode('utf-8').encode('unicode_escape').decode('utf-8') + '\033[0m')
-                
-                extrabytes_len = 0
-                try:
-                    newjson = json.loads(received_data[:newjson_len].decode('utf-8'))
-                except json.decoder.JSONDecodeError: # message is not valid json
-                    newjson = ''
-                else:
-                    if newjson.get('action', '') in ['LiveData', 'ScheduleData', 'currentImage', 'slideImage']:
-                        # json message says it will have extra bytes following
-                        extrabytes_len = int(newjson.get('size', 0))
-                finally:
-                    if len(received_data) >= (newjson_len + 2 + extrabytes_len): # message is complete incl extra bytes
-                        if newjson != '':
-                            # process received message
-                            procmsg_ew(newjson, received_data[(newjson_len + 2):(newjson_len + 2 + extrabytes_len)])
-                        # look in received data for another message
-                        received_data = received_data[(newjson_len + 2 + extrabytes_len):]
-                        newjson_len = received_data.find(b'\r\n')
-                    else:
-                        # don't have full message with all extra bytes, need to receive more data
-                        newjson_len = -1
+            return
+        if len(newdata) < 1:
+            return
+        bridge.record_io('ew', bridge.args.ew_host, 'rx', newdata)
+        bridge.ew_received = time.monotonic()
+        bridge.ew_heard = bridge.ew_received
+        for jsondata, rawdata in decoder.feed(newdata):
+            # process received message
+            bridge.procmsg_ew(jsondata, rawdata)
+
+
 
-    
-    
 
 
 
 # receive vm communications
-def recv_vm(vm_socket):
-    global vm_connected
-    received_data = b''
-    newmsg_len = -1
+async def recv_vm_async(bridge, link, vm_reader):
+    decoder = VMFrameDecoder()
     
-    while vm_connected:
+    while True:
         try:
-            vm_socket.settimeout(None)
-            # receive data from socket
-            received_data += vm_socket.recv(2048)
+            newdata = await vm_reader.read(2048)
         except OSError:
-            vm_connected = False
-        else:
-            if len(received_data) < 1:
-                vm_connected = False
-        finally:
-            # find first message delimiter
-            newmsg_len = received_data.find(b'\r\n')
-            while newmsg_len != -1:
-                print('RECV-VM: \33[92m' + received_data[:newmsg_len].decode('utf-8').encode('unicode_escape').decode('utf-8') + '\033[0m')
-                if newmsg_len > 0:
-                    # process received message
-                    procmsg_vm(received_data[:newmsg_len])
-                # look in received data for another message
-                received_data = received_data[(newmsg_len + 2):]
-                newmsg_len = received_data.find(b'\r\n')
+            return
+        if len(newdata) < 1:
+            return
+        bridge.record_io('vm', link.host, 'rx', newdata)
+        link.heard = time.monotonic()
+        frame_vm(bridge, link, decoder, newdata)
 
 
 
@@ -465,44 +2662,38 @@ def recv_vm(vm_socket):
 
 
 # send ew communication from outgoing message queue
-def send_ew(ew_socket):
-    global ew_connected
-    sentbytestimestamp = time.time()
+async def send_ew_async(bridge, ew_writer):
+    wakeup = asyncio.Event()
+    bridge.ew_txqueue.waker = wakeup.set
+    heartbeattimestamp = time.monotonic() + 3
     
-    while ew_connected:
-        outboundbytes = b''
-        try:
-            while True:
-                # retrieve queue until it's emptied
-                outboundbytes += ew_txqueue.popleft()
-        except IndexError:
-            # queue is empty
-            if len(outboundbytes) < 1:
-                # no messages retrieved from queue
-                if (time.time() - sentbytestimestamp) > 3:
+    try:
+        while True:
+            outboundbytes = bridge.ew_txqueue.popall(0)
+            if outboundbytes:
+                bridge.metrics.observe('ew2vm_batch_messages', bridge.ew_txqueue.batch, link='ew', host=bridge.args.ew_host)
+            else:
+                if time.monotonic() >= heartbeattimestamp:
                     # more than 3 seconds since last transmission, so transmit keepalive
-                    outboundbytes = ('{"action":"heartbeat","requestrev":' + str(requestrev) + '}\r\n').encode('utf-8')
+                    outboundbytes = bridge.ew_heartbeat()
                 else:
-                    # wait before checking the queue again
-                    time.sleep(0.002)
-            if len(outboundbytes) > 0:
-                sentbytecount_total = 0
-                while sentbytecount_total < len(outboundbytes):
+                    # sleep until a message is queued or it is time for the keepalive
+                    wakeup.clear()
                     try:
-                        ew_socket.settimeout(7)
-                        sentbytecount = ew_socket.send(outboundbytes[sentbytecount_total:])
-                        ew_socket.settimeout(None)
-                    except OSError:
-                        ew_connected = False
-                        outboundbytes = b''
-                    else:
-                        if sentbytecount < 1:
-                            ew_connected = False
-                            outboundbytes = b''
-                        else:
-                            sentbytestimestamp = time.time()
-                            print('SEND-EW: \33[95m' + outboundbytes[sentbytecount_total:sentbytecount_total + sentbytecount].decode('utf-8').encode('unicode_escape').decode('utf-8') + '\033[0m')
-                            sentbytecount_total += sentbytecount
+                        await asyncio.wait_for(wakeup.wait(), heartbeattimestamp - time.monotonic())
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            try:
+                ew_writer.write(outboundbytes)
+                await asyncio.wait_for(ew_writer.drain(), 7)
+            except (OSError, asyncio.TimeoutError):
+                return
+            heartbeattimestamp = time.monotonic() + 3
+            bridge.record_io('ew', bridge.args.ew_host, 'tx', outboundbytes)
+            log.wire('SEND-EW', '95', outboundbytes)
+    finally:
+        bridge.ew_txqueue.waker = None
 
 
 
@@ -510,37 +2701,34 @@ def send_ew(ew_socket):
 
 
 # send vm communication from outgoing message queue
-def send_vm(vm_socket):
-    global vm_connected
+async def send_vm_async(bridge, link, vm_writer):
+    wakeup = asyncio.Event()
+    link.txqueue.waker = wakeup.set
     
-    while vm_connected:
-        outboundbytes = b''
-        try:
-            while True:
-                # retrieve queue until it's emptied
-                outboundbytes += vm_txqueue.popleft()
-        except IndexError:
-            # queue is empty
-            if len(outboundbytes) < 1:
-                # no messages retrieved from queue, wait before checking the queue again
-                time.sleep(0.002)
-            else:
-                sentbytecount_total = 0
-                while sentbytecount_total < len(outboundbytes):
-                    try:
-                        vm_socket.settimeout(7)
-                        sentbytecount = vm_socket.send(outboundbytes[sentbytecount_total:])
-                        vm_socket.settimeout(None)
-                    except OSError:
-                        vm_connected = False
-                        outboundbytes = b''
-                    else:
-                        if sentbytecount < 1:
-                            vm_connected = False
-                            outboundbytes = b''
-                        else:
-                            print('SEND-VM: \33[93m' + outboundbytes[sentbytecount_total:sentbytecount_total + sentbytecount].decode('utf-8').encode('unicode_escape').decode('utf-8') + '\033[0m')
-                            sentbytecount_total += sentbytecount
+    try:
+        while True:
+            if len(link.txqueue) < 1:
+                # sleep until a message is queued
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            while link.txqueue.holdoff() > 0:
+                # let more updates pile up (and replace each other) until the interval is over
+                await asyncio.sleep(link.txqueue.holdoff())
+            outboundbytes = link.txqueue.popall(0)
+            stamp = link.txqueue.sent_stamp
+            bridge.metrics.observe('ew2vm_batch_messages', link.txqueue.batch, link='vm', host=link.host)
+            try:
+                vm_writer.write(outboundbytes)
+                await asyncio.wait_for(vm_writer.drain(), 7)
+            except (OSError, asyncio.TimeoutError):
+                return
+            bridge.record_io('vm', link.host, 'tx', outboundbytes)
+            if stamp is not None:
+                bridge.metrics.observe('ew2vm_slide_latency_seconds', time.monotonic() - stamp, host=link.host)
+            log.wire('SEND-VM', '93', outboundbytes)
+    finally:
+        link.txqueue.waker = None
 
 
 
@@ -550,5 +2738,3 @@ def send_vm(vm_socket):
 # main
 if __name__ == '__main__':
     main()
-
-
@@ -0,0 +1,164 @@
+# ew2vm_bench.py - drive ew2vm with synthetic EasyWorship load and measure how it copes
+# https://github.com/mikenor/ew2vm
+#
+# Runs ew2vm.py against the mock EasyWorship and vMix servers of ew2vm_replay.py, with
+# the mock EasyWorship playing a generated session instead of a captured one: a
+# schedule of presentations of a given size and slide text length, an operator
+# clicking through them at a given rate, edits to the live presentation and storms
+# of repeated status messages. Each case reports time-to-first-lyric, p50/p99 slide
+# change latency, CPU time and peak memory of ew2vm, bytes and vMix command counts,
+# as JSON lines with --json so runs of different builds can be compared. Arguments
+# after -- are passed to ew2vm.py:
+#
+#     python ew2vm_bench.py [--case NAME [NAME ...]] [--json] [-- EW2VM_ARGS ...]
+#     python ew2vm_bench.py --presentations 50 --slides 30 --changes 100 --rate 5 [-- EW2VM_ARGS ...]
+
+
+import argparse
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+
+import ew2vm_replay
+
+
+
+
+
+
+# generated ew session, with the same interface as ew2vm_replay.Scenario
+class SyntheticScenario:
+    def __init__(self, name, presentations=5, slides=20, text_size=60, changes=30, rate=2, clicks=10, edits=0, storm=1):
+        self.name = name
+        self.parameters = {'presentations': presentations, 'slides': slides, 'text_size': text_size, 'changes': changes, 'rate': rate, 'clicks': clicks, 'edits': edits, 'storm': storm}
+        self.connected = {'action': 'connected', 'requestrev': 1}
+        self.livedata = {} # liverev -> (pres_rowid, [(slide_rowid, revision), ...])
+        self.text_size = text_size
+        self.timeline = [] # (seconds after connect, header, rawdata)
+        self.vm_commands = None # nothing captured to compare with
+
+        # schedule, every presentation starting at revision 1
+        self.schedule = [(1000 + i, [((100000 * (i + 1)) + j, 1) for j in range(slides)]) for i in range(presentations)]
+
+        # operator moves to the next presentation every clicks slide changes, editing the live slide every edits changes
+        liverev = 0
+        pres_slides = []
+        for change in range(changes):
+            pres_rowid, schedule_slides = self.schedule[(change // clicks) % presentations]
+            if change % clicks == 0:
+                liverev += 1
+                pres_slides = list(schedule_slides)
+            slide_index = (change % clicks) % slides
+            if edits > 0 and change % clicks != 0 and change % edits == 0:
+                liverev += 1
+                slide_rowid, revision = pres_slides[slide_index]
+                pres_slides[slide_index] = (slide_rowid, revision + 1)
+            self.livedata[liverev] = (pres_rowid, list(pres_slides))
+            slide_rowid, revision = pres_slides[slide_index]
+            status = {'action': 'status', 'requestrev': 1, 'liverev': liverev, 'imagehash': str(slide_rowid) + '-' + str(revision), 'slide_rowid': slide_rowid, 'logo': False, 'black': False, 'clear': False, 'schedulerev': 1}
+            for repeat in range(storm):
+                self.timeline.append(((change / rate) + (repeat * 0.001), status, b''))
+
+    # LiveData payload of a presentation, also how each schedule item is laid out
+    def presentation_rawdata(self, liverev, pres_rowid, pres_slides):
+        return struct.pack('<lqqqlq', 0, liverev, pres_rowid, 1, len(pres_slides), 0) + b''.join(struct.pack('<qq', slide_rowid, revision) for slide_rowid, revision in pres_slides)
+
+    def slide_text(self, slide_rowid, revision):
+        line = 'Line of slide ' + str(slide_rowid) + ' revision ' + str(revision) + '\n'
+        return (line * ((self.text_size // len(line)) + 1))[:self.text_size]
+
+    # messages answering a request from ew2vm, liverev being that of the last status sent
+    def answer(self, request, liverev):
+        action = request.get('action', '')
+        if action == 'connect':
+            return [(self.connected, b'')]
+        if action == 'GetLiveData':
+            if liverev not in self.livedata:
+                return []
+            rawdata = self.presentation_rawdata(liverev, *self.livedata[liverev])
+            return [({'action': 'LiveData', 'requestrev': 1, 'size': len(rawdata)}, rawdata)]
+        if action == 'GetScheduleData':
+            rawdata = struct.pack('<ll', 0, len(self.schedule)) + b''.join(self.presentation_rawdata(0, pres_rowid, pres_slides) for pres_rowid, pres_slides in self.schedule)
+            return [({'action': 'ScheduleData', 'requestrev': 1, 'size': len(rawdata)}, rawdata)]
+        if action == 'getSlideInfo':
+            slide_rowid = int(request.get('slide_rowid', 0))
+            if slide_rowid == 0:
+                return [({'action': 'slideInfo', 'requestrev': 1, 'slide_rowid': 0, 'title': 'Song ' + str(request.get('pres_rowid', 0))}, b'')]
+            return [({'action': 'slideInfo', 'requestrev': 1, 'slide_rowid': slide_rowid, 'title': 'Verse ' + str(slide_rowid % 100000), 'content': self.slide_text(slide_rowid, int(request.get('revision', 0)))}, b'')]
+        return []
+
+
+# built-in cases, keyword arguments of SyntheticScenario
+cases = {
+    'baseline': {},
+    'long-presentation': {'presentations': 1, 'slides': 2000, 'changes': 20, 'clicks': 20},
+    'big-schedule': {'presentations': 50, 'slides': 30, 'changes': 100, 'rate': 5},
+    'fast-clicks': {'presentations': 3, 'slides': 40, 'changes': 100, 'rate': 5, 'clicks': 40},
+    'edits': {'presentations': 2, 'slides': 50, 'changes': 40, 'clicks': 20, 'edits': 3},
+    'status-storm': {'presentations': 3, 'slides': 20, 'changes': 60, 'rate': 5, 'storm': 10},
+    'big-text': {'presentations': 2, 'slides': 30, 'text_size': 4000, 'changes': 30},
+}
+
+
+
+
+
+
+# commit of the ew2vm.py being measured, if it is in a git checkout
+def build_id():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argv = sys.argv[1:]
+    ew2vm_args = ['--vm-input', '1']
+    if '--' in argv:
+        ew2vm_args = argv[(argv.index('--') + 1):]
+        argv = argv[:argv.index('--')]
+
+    arg_parser = argparse.ArgumentParser(usage='%(prog)s [options] [-- EW2VM_ARGS ...]', description='Benchmarks ew2vm.py against a synthetic EasyWorship session and a mock vMix on ::1. Without any of the session options, runs the built-in cases.')
+    arg_parser.add_argument('--case', nargs='+', choices=list(cases), metavar='NAME', help='built-in cases to run: ' + ', '.join(cases) + ' (default all)')
+    arg_parser.add_argument('--presentations', type=int, metavar='N', help='presentations/songs in the schedule')
+    arg_parser.add_argument('--slides', type=int, metavar='N', help='slides per presentation/song')
+    arg_parser.add_argument('--text-size', type=int, metavar='BYTES', help='length of the text of each slide')
+    arg_parser.add_argument('--changes', type=int, metavar='N', help='slide changes by the operator')
+    arg_parser.add_argument('--rate', type=float, metavar='N', help='slide changes per second')
+    arg_parser.add_argument('--clicks', type=int, metavar='N', help='slide changes before moving on to the next presentation/song')
+    arg_parser.add_argument('--edits', type=int, metavar='N', help='edit the live slide every N slide changes, giving the presentation/song a new revision')
+    arg_parser.add_argument('--storm', type=int, metavar='N', help='send every status message N times')
+    arg_parser.add_argument('--speed', type=float, default=1, metavar='N', help='play the session N times as fast, 0 for no waiting between slide changes (default 1, real time)')
+    arg_parser.add_argument('--settle', type=float, default=2, metavar='SECONDS', help='keep running this long after the last slide change (default 2)')
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    arg_parser.add_argument('--verbose', action='store_true', help='show the console output of ew2vm.py')
+    args = arg_parser.parse_args(argv)
+
+    custom = {key: getattr(args, key) for key in ('presentations', 'slides', 'text_size', 'changes', 'rate', 'clicks', 'edits', 'storm') if getattr(args, key) is not None}
+    scenarios = [SyntheticScenario('custom', **custom)] if custom else [SyntheticScenario(name, **cases[name]) for name in (args.case or cases)]
+
+    build = build_id()
+    for scenario in scenarios:
+        try:
+            result = ew2vm_replay.run_scenario(scenario, ew2vm_args, args.speed, args.settle, args.verbose)
+        except (OSError, ValueError, RuntimeError) as e:
+            result = {'scenario': scenario.name, 'error': str(e)}
+        result.update({'parameters': scenario.parameters, 'ew2vm_args': ew2vm_args, 'build': build, 'python': platform.python_version()})
+        result.pop('vm_commands_captured', None)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('  '.join(key + ' ' + str(value) for key, value in result.items()))
+        sys.stdout.flush()
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
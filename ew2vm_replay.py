@@ -0,0 +1,451 @@
+# ew2vm_replay.py - replay captured EasyWorship sessions through ew2vm against mock EasyWorship and vMix servers
+# https://github.com/mikenor/ew2vm
+#
+# Record a session with `ew2vm.py --capture FILE ...`, then replay it on any machine,
+# no EasyWorship or vMix needed. The mock EasyWorship answers the mDNS lookup on
+# [::1]:5353, `connect`, `GetLiveData`, `GetScheduleData` and `getSlideInfo` with
+# what was captured, and sends the captured status messages on their original
+# schedule (or faster with --speed). The mock vMix on [::1]:8099 records the commands
+# it receives. For each capture, time-to-first-text, slide latency, bytes and the CPU
+# time and peak memory of ew2vm are reported. Arguments after -- are passed to ew2vm.py:
+#
+#     python ew2vm_replay.py [--speed N] [--settle SECONDS] [--json] CAPTURE [CAPTURE ...] [-- EW2VM_ARGS ...]
+
+
+import argparse
+import base64
+import collections
+import json
+import math
+import os
+import signal
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rrset
+
+import ew2vm
+
+
+
+
+
+
+# captured ew session: the messages ew sent unprompted on a timeline, and its answers to requests
+class Scenario:
+    answer_actions = ('connected', 'LiveData', 'ScheduleData', 'slideInfo')
+
+    def __init__(self, path):
+        self.name = os.path.basename(path)
+        self.connected = {'action': 'connected', 'requestrev': 1}
+        self.livedata = collections.OrderedDict() # liverev -> (header, rawdata)
+        self.scheduledata = None
+        self.slideinfo = {} # (pres_rowid, slide_rowid, revision) -> header
+        self.slideinfo_latest = {} # slide_rowid -> header, for requests with a revision that was never captured
+        self.timeline = [] # (seconds after connect, header, rawdata)
+        self.vm_commands = 0
+
+        records = []
+        with open(path, 'r', encoding='utf-8') as capture_file:
+            for line in capture_file:
+                if line.strip():
+                    records.append(json.loads(line))
+
+        # only the first ew session counts, anything after a reconnect would be replayed twice
+        connects = [record['t'] for record in records if record.get('event') == 'connect' and record.get('link') == 'ew']
+        if not connects:
+            raise ValueError('no EasyWorship connection in ' + path)
+        session_start = connects[0]
+        session_end = connects[1] if len(connects) > 1 else float('inf')
+
+        requests = collections.defaultdict(collections.deque) # slide_rowid -> requested (pres_rowid, slide_rowid, revision), in order
+        decoder = ew2vm.EWFrameDecoder()
+        tx_buffer = b''
+        for record in records:
+            if 'data' not in record or not (session_start <= record['t'] < session_end):
+                continue
+            data = base64.b64decode(record['data'])
+            if record['link'] == 'vm':
+                if record['dir'] == 'tx':
+                    self.vm_commands += data.count(b'\r\n')
+                continue
+
+            if record['dir'] == 'tx':
+                # remember slide info requests, their answers only say which slide they are for
+                tx_buffer += data
+                while b'\r\n' in tx_buffer:
+                    line, tx_buffer = tx_buffer.split(b'\r\n', 1)
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue
+                    if request.get('action') == 'getSlideInfo':
+                        requests[int(request['slide_rowid'])].append((int(request['pres_rowid']), int(request['slide_rowid']), int(request['revision'])))
+                continue
+
+            messages = [(header, bytes(rawdata)) for header, rawdata in decoder.feed(data)]
+            for header, rawdata in messages:
+                action = header.get('action', '')
+                if action == 'connected':
+                    self.connected = header
+                elif action == 'LiveData':
+                    try:
+                        self.livedata[ew2vm.unpack_presentation(rawdata)[0]] = (header, rawdata)
+                    except struct.error:
+                        pass
+                elif action == 'ScheduleData':
+                    self.scheduledata = (header, rawdata)
+                elif action == 'slideInfo' and 'slide_rowid' in header:
+                    slide_rowid = int(header['slide_rowid'])
+                    self.slideinfo_latest[slide_rowid] = header
+                    if requests[slide_rowid]:
+                        self.slideinfo[requests[slide_rowid].popleft()] = header
+                elif action not in self.answer_actions:
+                    self.timeline.append((record['t'] - session_start, header, rawdata))
+
+    # messages answering a request from ew2vm, liverev being that of the last status sent
+    def answer(self, request, liverev):
+        action = request.get('action', '')
+        if action == 'connect':
+            return [(self.connected, b'')]
+        if action == 'GetLiveData':
+            if liverev in self.livedata:
+                return [self.livedata[liverev]]
+            return []
+        if action == 'GetScheduleData':
+            return [self.scheduledata] if self.scheduledata else []
+        if action == 'getSlideInfo':
+            key = (int(request.get('pres_rowid', 0)), int(request.get('slide_rowid', 0)), int(request.get('revision', 0)))
+            header = self.slideinfo.get(key, self.slideinfo_latest.get(key[1]) if key[1] != 0 else None)
+            return [(header, b'')] if header else []
+        return []
+
+
+
+
+
+
+# answers mdns PTR queries for _ezwremote._tcp with a SRV record pointing at port
+def serve_mdns(port, stopping):
+    mdns_socket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    mdns_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    mdns_socket.bind(('::1', 5353))
+    mdns_socket.settimeout(0.2)
+    try:
+        while not stopping.is_set():
+            try:
+                query, address = mdns_socket.recvfrom(4096)
+            except socket.timeout:
+                continue
+            try:
+                response = dns.message.make_response(dns.message.from_wire(query))
+            except dns.exception.DNSException:
+                continue
+            response.flags |= dns.flags.AA
+            response.answer.append(dns.rrset.from_text('_ezwremote._tcp.local.', 10, 'IN', 'PTR', 'EW2VMREPLAY._ezwremote._tcp.local.'))
+            response.additional.append(dns.rrset.from_text('EW2VMREPLAY._ezwremote._tcp.local.', 10, 'IN', 'SRV', '0 0 ' + str(port) + ' localhost.'))
+            mdns_socket.sendto(response.to_wire(), address)
+    finally:
+        mdns_socket.close()
+
+
+
+
+
+
+# stop listening, shutting down first so a thread blocked in accept() lets go of the port
+def close_server(server_socket):
+    try:
+        server_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    server_socket.close()
+
+
+
+
+
+
+# mock easyworship: answers requests from the scenario, plays its timeline once the first client has connected
+class MockEW:
+    def __init__(self, scenario, speed=1):
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.clients = []
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.liverev = None
+        self.scenario = scenario
+        self.speed = speed
+        self.status = None
+        self.status_sent = [] # (time, header) of every status sent
+        self.stopping = threading.Event()
+        self.timeline_done = threading.Event()
+        self.server_socket = socket.socket(socket.AF_INET6)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('::1', 0))
+        self.server_socket.listen()
+        self.port = self.server_socket.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=serve_mdns, args=(self.port, self.stopping), daemon=True).start()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        close_server(self.server_socket)
+        for client in list(self.clients):
+            client.close()
+
+    def accept(self):
+        while not self.stopping.is_set():
+            try:
+                client, address = self.server_socket.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def send(self, client, header, rawdata=b''):
+        message = json.dumps(header).encode('utf-8') + b'\r\n' + rawdata
+        with self.lock:
+            if header.get('action') == 'status':
+                self.status = header
+                self.liverev = int(header.get('liverev', -1))
+                self.status_sent.append((time.monotonic(), header))
+            try:
+                client.sendall(message)
+            except OSError:
+                return
+            self.bytes_sent += len(message)
+
+    def serve(self, client):
+        received_data = b''
+        while True:
+            try:
+                newdata = client.recv(65536)
+            except OSError:
+                return
+            if len(newdata) < 1:
+                return
+            self.bytes_received += len(newdata)
+            received_data += newdata
+            while b'\r\n' in received_data:
+                line, received_data = received_data.split(b'\r\n', 1)
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+                for header, rawdata in self.scenario.answer(request, self.liverev):
+                    self.send(client, header, rawdata)
+                if request.get('action') == 'connect':
+                    if not self.connected.is_set():
+                        self.connected.set()
+                        threading.Thread(target=self.play, args=(client,), daemon=True).start()
+                    elif self.status:
+                        self.send(client, self.status)
+
+    # send the timeline, sped up by speed (0 for no waiting at all)
+    def play(self, client):
+        started = time.monotonic()
+        for t, header, rawdata in self.scenario.timeline:
+            if self.speed > 0:
+                delay = started + (t / self.speed) - time.monotonic()
+                if delay > 0 and self.stopping.wait(delay):
+                    return
+            self.send(client, header, rawdata)
+        self.timeline_done.set()
+
+
+
+
+
+
+# mock vmix: records every command line received, answers FUNCTION commands with OK
+class MockVM:
+    def __init__(self, port=8099):
+        self.bytes_received = 0
+        self.received = [] # (time, line)
+        self.stopping = threading.Event()
+        self.server_socket = socket.socket(socket.AF_INET6)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('::1', port))
+        self.server_socket.listen()
+        self.clients = []
+
+    def start(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        close_server(self.server_socket)
+        for client in list(self.clients):
+            client.close()
+
+    def accept(self):
+        while not self.stopping.is_set():
+            try:
+                client, address = self.server_socket.accept()
+            except OSError:
+                return
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        received_data = b''
+        try:
+            client.sendall(b'VERSION OK 24.0.0.0\r\n')
+            while True:
+                newdata = client.recv(65536)
+                if len(newdata) < 1:
+                    return
+                self.bytes_received += len(newdata)
+                received_data += newdata
+                while b'\r\n' in received_data:
+                    line, received_data = received_data.split(b'\r\n', 1)
+                    self.received.append((time.monotonic(), line))
+                    if line.startswith(b'FUNCTION '):
+                        client.sendall(b'FUNCTION OK Completed\r\n')
+                    elif line == b'TALLY':
+                        client.sendall(b'TALLY OK 0\r\n')
+        except OSError:
+            return
+
+
+
+
+
+
+# time from each status with a new slide to the next SetText that vmix received, before the next slide (repeated statuses don't count)
+def slide_latencies(status_sent, received):
+    latencies = []
+    imagehash = None
+    settexts = [t for t, line in received if line.startswith(b'FUNCTION SetText ')]
+    for i, (sent, header) in enumerate(status_sent):
+        if header.get('imagehash') == imagehash:
+            continue
+        imagehash = header.get('imagehash')
+        until = next((later for later, later_header in status_sent[(i + 1):] if later_header.get('imagehash') != imagehash), float('inf'))
+        for t in settexts:
+            if sent <= t < until:
+                latencies.append(t - sent)
+                break
+    return latencies
+
+
+# nearest-rank percentile
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+# wait for ew2vm to exit, killing it after timeout, returns its resource usage where the platform reports it per process (None elsewhere)
+def reap(process, timeout):
+    if not hasattr(os, 'wait4'):
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        return None
+    deadline = time.monotonic() + timeout
+    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    while not pid:
+        if time.monotonic() > deadline:
+            process.kill()
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        time.sleep(0.05)
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return usage
+
+
+# run ew2vm against mock servers for one scenario, returns results
+def run_scenario(scenario, ew2vm_args, speed=1, settle=2, verbose=False, connect_timeout=15):
+    mock_ew = MockEW(scenario, speed)
+    mock_vm = MockVM()
+    mock_ew.start()
+    mock_vm.start()
+    started = time.monotonic()
+    usage = None
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ew2vm.py')] + ew2vm_args, stdout=(None if verbose else subprocess.DEVNULL), stderr=subprocess.STDOUT)
+    try:
+        if not mock_ew.connected.wait(connect_timeout):
+            raise RuntimeError('ew2vm did not connect to the mock EasyWorship within ' + str(connect_timeout) + ' seconds')
+        while not mock_ew.timeline_done.wait(0.1):
+            if process.poll() is not None:
+                raise RuntimeError('ew2vm exited with ' + str(process.returncode))
+        time.sleep(settle)
+    finally:
+        process.send_signal(signal.SIGINT)
+        usage = reap(process, 10)
+        mock_ew.stop()
+        mock_vm.stop()
+
+    latencies = slide_latencies(mock_ew.status_sent, mock_vm.received)
+    settexts = [t for t, line in mock_vm.received if line.startswith(b'FUNCTION SetText ')]
+    first_status = mock_ew.status_sent[0][0] if mock_ew.status_sent else None
+    return {
+        'scenario': scenario.name,
+        'speed': speed,
+        'duration_s': round(time.monotonic() - started, 3),
+        'time_to_first_text_ms': round((settexts[0] - first_status) * 1000, 3) if (settexts and first_status is not None and settexts[0] >= first_status) else None,
+        'slide_changes': len(latencies),
+        'slide_latency_p50_ms': round(statistics.median(latencies) * 1000, 3) if latencies else None,
+        'slide_latency_p99_ms': round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        'slide_latency_max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+        'cpu_s': round(usage.ru_utime + usage.ru_stime, 3) if usage else None,
+        'peak_rss_kb': (usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss) if usage else None,
+        'ew_bytes_to_ew2vm': mock_ew.bytes_sent,
+        'ew2vm_bytes_to_ew': mock_ew.bytes_received,
+        'ew2vm_bytes_to_vm': mock_vm.bytes_received,
+        'vm_commands': len(mock_vm.received),
+        'vm_commands_captured': scenario.vm_commands,
+    }
+
+
+
+
+
+
+def main():
+    argv = sys.argv[1:]
+    ew2vm_args = ['--vm-input', '1']
+    if '--' in argv:
+        ew2vm_args = argv[(argv.index('--') + 1):]
+        argv = argv[:argv.index('--')]
+
+    arg_parser = argparse.ArgumentParser(usage='%(prog)s [options] CAPTURE [CAPTURE ...] [-- EW2VM_ARGS ...]', description='Replays sessions captured with ew2vm.py --capture through ew2vm.py against mock EasyWorship and vMix servers on ::1.')
+    arg_parser.add_argument('captures', nargs='+', metavar='CAPTURE', help='capture file written by ew2vm.py --capture')
+    arg_parser.add_argument('--speed', type=float, default=1, metavar='N', help='play the captured EasyWorship status messages N times as fast, 0 for no waiting between them (default 1, real time)')
+    arg_parser.add_argument('--settle', type=float, default=2, metavar='SECONDS', help='keep running this long after the last status message (default 2)')
+    arg_parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    arg_parser.add_argument('--verbose', action='store_true', help='show the console output of ew2vm.py')
+    args = arg_parser.parse_args(argv)
+
+    for path in args.captures:
+        try:
+            result = run_scenario(Scenario(path), ew2vm_args, args.speed, args.settle, args.verbose)
+        except (OSError, ValueError, RuntimeError) as e:
+            result = {'scenario': os.path.basename(path), 'error': str(e)}
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('  '.join(key + ' ' + str(value) for key, value in result.items()))
+
+
+
+
+
+
+if __name__ == '__main__':
+    main()
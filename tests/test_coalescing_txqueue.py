@@ -0,0 +1,65 @@
+# test_coalescing_txqueue.py - order and coalescing of the vMix transmit queue
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+class CoalescingTxQueueTest(unittest.TestCase):
+    def test_newer_message_replaces_older_one_in_its_place(self):
+        txqueue = ew2vm.CoalescingTxQueue()
+        txqueue.append(b'text A\r\n', ('textbox', 'text'))
+        txqueue.append(b'credit A\r\n', ('textbox_credit', 'text'))
+        txqueue.append(b'text B\r\n', ('textbox', 'text'))
+        self.assertEqual(txqueue.popall(0), b'text B\r\ncredit A\r\n')
+        self.assertEqual(txqueue.coalesced, 1)
+    
+    def test_unkeyed_messages_are_all_sent(self):
+        txqueue = ew2vm.CoalescingTxQueue()
+        txqueue.append(b'XML\r\n')
+        txqueue.append(b'XML\r\n')
+        self.assertEqual(txqueue.popall(0), b'XML\r\nXML\r\n')
+    
+    def test_text_is_set_before_it_is_shown(self):
+        link = ew2vm.VMLink('::1', 0)
+        link.add_target(ew2vm.VMTarget('::1', 5, 0, 1))
+        link.txqueue.append(link.settext_command('textbox', b'B'), ('textbox', 'text'))
+        link.txqueue.append(link.visible_commands['On'], ('visible',))
+        link.txqueue.append(link.settext_command('textbox', b'C'), ('textbox', 'text'))
+        self.assertEqual(link.txqueue.popall(0), link.settext_command('textbox', b'C') + link.visible_commands['On'])
+    
+    def test_text_hidden_before_it_is_replaced_stays_hidden_first(self):
+        link = ew2vm.VMLink('::1', 0)
+        link.add_target(ew2vm.VMTarget('::1', 5, 0, 1))
+        link.txqueue.append(link.visible_commands['Off'], ('visible',))
+        link.txqueue.append(link.settext_command('textbox', b'C'), ('textbox', 'text'))
+        self.assertEqual(link.txqueue.popall(0), link.visible_commands['Off'] + link.settext_command('textbox', b'C'))
+    
+    def test_min_interval_holds_back_the_next_batch(self):
+        txqueue = ew2vm.CoalescingTxQueue(0.2)
+        txqueue.append(b'text A\r\n', ('textbox', 'text'))
+        self.assertEqual(txqueue.popall(0), b'text A\r\n')
+        self.assertGreater(txqueue.holdoff(), 0)
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
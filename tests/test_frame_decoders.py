@@ -0,0 +1,110 @@
+# test_frame_decoders.py - EWFrameDecoder and VMFrameDecoder frame messages however the receive stream is split
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+class EWFrameDecoderTest(unittest.TestCase):
+    payload = bytes(range(256)) * 4
+    stream = b'{"action":"status","liverev":1}\r\n{"action":"slideImage","requestrev":1,"size":1024}\r\n' + payload + b'{"action":"status","liverev":2}\r\n'
+    
+    def frame(self, decoder, chunks):
+        # rawdata is only valid until the next message, copy it
+        return [(jsondata, bytes(rawdata)) for chunk in chunks for jsondata, rawdata in decoder.feed(chunk)]
+    
+    def expected(self, payload=payload):
+        return [({'action': 'status', 'liverev': 1}, b''), ({'action': 'slideImage', 'requestrev': 1, 'size': 1024}, payload), ({'action': 'status', 'liverev': 2}, b'')]
+    
+    def test_stream_in_one_read(self):
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [self.stream]), self.expected())
+    
+    def test_stream_one_byte_per_read(self):
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [self.stream[i:(i + 1)] for i in range(len(self.stream))]), self.expected())
+    
+    def test_header_split_across_reads(self):
+        split = self.stream.index(b'slideImage')
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [self.stream[:split], self.stream[split:]]), self.expected())
+    
+    def test_delimiter_split_across_reads(self):
+        split = self.stream.index(b'\r\n') + 1
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [self.stream[:split], self.stream[split:]]), self.expected())
+    
+    def test_size_field_straddling_reads(self):
+        split = self.stream.index(b'1024') + 2
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [self.stream[:split], self.stream[split:]]), self.expected())
+    
+    def test_payload_split_across_reads(self):
+        start = self.stream.index(self.payload)
+        chunks = [self.stream[:(start + 10)], self.stream[(start + 10):(start + 500)], self.stream[(start + 500):]]
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), chunks), self.expected())
+    
+    def test_invalid_json_line_is_skipped(self):
+        self.assertEqual(self.frame(ew2vm.EWFrameDecoder(), [b'not json\r\n[1]\r\n' + self.stream]), self.expected())
+    
+    def test_payload_goes_to_sink_as_it_arrives(self):
+        sink = io.BytesIO()
+        decoder = ew2vm.EWFrameDecoder(lambda jsondata: sink if jsondata['action'] == 'slideImage' else None)
+        start = self.stream.index(self.payload)
+        messages = self.frame(decoder, [self.stream[:(start + 100)]])
+        self.assertEqual(sink.getvalue(), self.payload[:100])
+        messages += self.frame(decoder, [self.stream[(start + 100):]])
+        self.assertEqual(sink.getvalue(), self.payload)
+        self.assertEqual(messages, self.expected(b''))
+
+
+
+
+
+
+class VMFrameDecoderTest(unittest.TestCase):
+    state = b'<vmix><version>27</version></vmix>\r\n'
+    stream = b'SUBSCRIBE OK ACTS Subscribed\r\nXML ' + str(len(state)).encode('utf-8') + b'\r\n' + state + b'ACTS OK Input 5 1\r\n'
+    
+    def frame(self, chunks):
+        decoder = ew2vm.VMFrameDecoder()
+        return [message for chunk in chunks for message in decoder.feed(chunk)]
+    
+    def expected(self):
+        return [(b'SUBSCRIBE OK ACTS Subscribed', b''), (b'XML ' + str(len(self.state)).encode('utf-8'), self.state), (b'ACTS OK Input 5 1', b'')]
+    
+    def test_stream_in_one_read(self):
+        self.assertEqual(self.frame([self.stream]), self.expected())
+    
+    def test_stream_one_byte_per_read(self):
+        self.assertEqual(self.frame([self.stream[i:(i + 1)] for i in range(len(self.stream))]), self.expected())
+    
+    def test_size_field_straddling_reads(self):
+        split = self.stream.index(b'XML ') + 5
+        self.assertEqual(self.frame([self.stream[:split], self.stream[split:]]), self.expected())
+    
+    def test_payload_split_across_reads(self):
+        split = self.stream.index(b'<version>')
+        self.assertEqual(self.frame([self.stream[:split], self.stream[split:]]), self.expected())
+    
+    def test_xml_line_without_length_has_no_payload(self):
+        self.assertEqual(self.frame([b'XML\r\nTALLY OK 0120\r\n']), [(b'XML', b''), (b'TALLY OK 0120', b'')])
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# test_parse_config.py - parse_config turns a supervisor config file into the arguments of each bridge
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+class ParseConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'rooms.json')
+    
+    def write(self, text):
+        with open(self.path, 'w', encoding='utf-8') as config_file:
+            config_file.write(text)
+    
+    # parse_config exits with its error message, or argparse prints its own for the arguments of a bridge
+    def assertRejected(self, config, message):
+        self.write(config if isinstance(config, str) else json.dumps(config))
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            with self.assertRaises(SystemExit) as raised:
+                ew2vm.parse_config(self.path)
+        self.assertIn(message, str(raised.exception.code) + stderr.getvalue())
+    
+    def test_bridges_in_order_with_their_own_arguments(self):
+        self.write(json.dumps([{'name': 'north', 'args': ['--vm-input', 5, '--uppercase']}, {'args': ['--vm-input', '6', '--ew-host', 'ewpc']}]))
+        bridges_args = ew2vm.parse_config(self.path)
+        self.assertEqual([name for name, args in bridges_args], ['north', 'bridge 2'])
+        self.assertEqual(bridges_args[0][1].vm_input, 5)
+        self.assertTrue(bridges_args[0][1].uppercase)
+        self.assertEqual(bridges_args[1][1].vm_input, 6)
+        self.assertEqual(bridges_args[1][1].ew_host, 'ewpc')
+        self.assertFalse(bridges_args[1][1].uppercase)
+    
+    def test_missing_file_is_rejected(self):
+        with self.assertRaises(SystemExit) as raised:
+            ew2vm.parse_config(os.path.join(self.directory, 'missing.json'))
+        self.assertIn('could not read config file', raised.exception.code)
+    
+    def test_invalid_json_is_rejected(self):
+        self.assertRejected('[{"name": "north",', 'could not read config file')
+    
+    def test_wrong_shape_is_rejected(self):
+        self.assertRejected({'name': 'north', 'args': ['--vm-input', '5']}, 'should be a list')
+        self.assertRejected([], 'should be a list')
+        self.assertRejected([{'name': 'north', 'args': '--vm-input 5'}], 'should be a list')
+    
+    def test_duplicate_names_are_rejected(self):
+        self.assertRejected([{'name': 'north', 'args': ['--vm-input', '5']}, {'name': 'north', 'args': ['--vm-input', '6']}], 'more than one bridge named')
+    
+    def test_metrics_port_of_a_bridge_is_rejected(self):
+        self.assertRejected([{'name': 'north', 'args': ['--vm-input', '5', '--metrics-port', '9100']}], 'belongs on the command line')
+    
+    def test_nested_config_is_rejected(self):
+        self.assertRejected([{'name': 'north', 'args': ['--config', 'other.json']}], 'ew2vm.py [north]: error: --config is not allowed in a config file')
+    
+    def test_bridge_without_target_is_rejected(self):
+        self.assertRejected([{'name': 'north', 'args': ['--uppercase']}], 'ew2vm.py [north]: error: one of the arguments --vm-input --vm-target --config is required')
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# test_publisher.py - Publisher serves a snapshot then updates, and copes with subscribers that stop reading or go away
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import json
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+
+
+
+
+class PublisherTest(unittest.TestCase):
+    def start_publisher(self, max_backlog=65536):
+        publisher = ew2vm.Publisher('127.0.0.1', 0, max_backlog)
+        publisher.start()
+        self.addCleanup(publisher.stop)
+        return publisher
+    
+    def subscribe(self, publisher, rcvbuf=None):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf:
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        client.connect(publisher.server.getsockname())
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        self.assertTrue(wait_for(lambda: len(publisher.clients) == 1))
+        return client, client.makefile('rb')
+    
+    def test_snapshot_then_changed_fields_only(self):
+        publisher = self.start_publisher()
+        publisher.publish(title='Amazing Grace', visible=True)
+        client, lines = self.subscribe(publisher)
+        self.assertEqual(json.loads(lines.readline()), {'type': 'snapshot', 'title': 'Amazing Grace', 'credit': None, 'slide_title': None, 'text': None, 'visible': True})
+        
+        publisher.publish(title='Amazing Grace', text='How sweet the sound')
+        publisher.publish(visible=True) # nothing changed, nothing sent
+        publisher.publish(visible=False)
+        self.assertEqual(json.loads(lines.readline()), {'type': 'update', 'text': 'How sweet the sound'})
+        self.assertEqual(json.loads(lines.readline()), {'type': 'update', 'visible': False})
+    
+    def test_closed_subscriber_is_dropped(self):
+        publisher = self.start_publisher()
+        client, lines = self.subscribe(publisher)
+        lines.close()
+        client.close()
+        self.assertTrue(wait_for(lambda: not publisher.clients))
+    
+    def test_slow_subscriber_gets_snapshot_instead_of_backlog(self):
+        publisher = self.start_publisher(max_backlog=4096)
+        client, lines = self.subscribe(publisher, rcvbuf=4096)
+        self.assertEqual(json.loads(lines.readline())['type'], 'snapshot')
+        
+        # subscriber reads nothing while the text keeps changing
+        for i in range(1000):
+            publisher.publish(text=str(i) + ' ' + 'x' * 1000)
+            if publisher.resyncs:
+                break
+        self.assertTrue(wait_for(lambda: publisher.resyncs > 0))
+        publisher.publish(visible=False)
+        
+        # once it reads again, it gets whole lines and catches up on the current state
+        state = {}
+        while state.get('visible') is not False:
+            message = json.loads(lines.readline())
+            if message.pop('type') == 'snapshot':
+                state = message
+            else:
+                state.update(message)
+        self.assertEqual(state['text'], str(i) + ' ' + 'x' * 1000)
+        self.assertEqual(len(publisher.clients), 1)
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
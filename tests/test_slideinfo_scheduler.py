@@ -0,0 +1,103 @@
+# test_slideinfo_scheduler.py - SlideInfoScheduler keeps the live slide first when ew does not answer
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+class SlideInfoSchedulerTest(unittest.TestCase):
+    def test_new_live_slide_goes_before_requests_of_previous_presentation(self):
+        scheduler = ew2vm.SlideInfoScheduler(1, 0.01)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE_SLIDE, 100, 11, 1)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE, 100, 12, 1)
+        self.assertEqual(scheduler.pump(0, 1), [(100, 11, 1)])
+        
+        # presentation 200 goes live while ew has not answered anything
+        scheduler.cancel(ew2vm.SlideInfoScheduler.LIVE_SLIDE)
+        scheduler.cancel(ew2vm.SlideInfoScheduler.LIVE)
+        scheduler.demote(200)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE_SLIDE, 200, 21, 1)
+        
+        sent = []
+        for tick in range(1, 4):
+            sent += scheduler.pump(tick, 1)
+        self.assertEqual(sent[0], (200, 21, 1))
+        self.assertEqual(sent.count((200, 21, 1)), 3)
+        self.assertEqual(sent.count((100, 11, 1)), 0)
+    
+    def test_live_requests_are_given_up_after_retries(self):
+        scheduler = ew2vm.SlideInfoScheduler(8, 0.01)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE, 100, 11, 1)
+        sent = []
+        for tick in range(10):
+            sent += scheduler.pump(tick, 1)
+        self.assertEqual(len(sent), 1 + ew2vm.SlideInfoScheduler.retries[ew2vm.SlideInfoScheduler.LIVE])
+        self.assertEqual(scheduler.abandoned, [(100, 11, 1)])
+        self.assertFalse(scheduler.busy())
+    
+    def test_edited_slide_is_requested_again_while_old_revision_is_in_flight(self):
+        scheduler = ew2vm.SlideInfoScheduler(8, 2)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE, 100, 11, 1)
+        self.assertEqual(scheduler.pump(0, 1), [(100, 11, 1)])
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE_SLIDE, 100, 11, 2)
+        self.assertEqual(scheduler.pump(0.1, 1), [(100, 11, 2)])
+        
+        # ew answers in order, the first answer is for the old revision
+        self.assertEqual(scheduler.answered(11), (100, 1))
+        self.assertEqual(scheduler.answered(11), (100, 2))
+        self.assertFalse(scheduler.busy())
+    
+    def test_stale_timeouts_do_not_shrink_window(self):
+        scheduler = ew2vm.SlideInfoScheduler(8, 0.01)
+        scheduler.request(ew2vm.SlideInfoScheduler.LIVE, 100, 11, 1)
+        scheduler.pump(0, 1)
+        scheduler.demote(200)
+        scheduler.pump(1, 1)
+        self.assertEqual(scheduler.window, 8)
+
+
+
+
+
+
+class BridgeSlideInfoTest(unittest.TestCase):
+    def livedata(self, bridge, liverev, revision):
+        rawdata = struct.pack('<lqqqlq', 0, liverev, 100, 1, 1, 0) + struct.pack('<qq', 11, revision)
+        bridge.procmsg_ew({'action': 'status', 'liverev': liverev, 'imagehash': 'h' + str(revision), 'slide_rowid': 11, 'requestrev': 1}, b'')
+        bridge.procmsg_ew({'action': 'LiveData', 'requestrev': 1, 'size': len(rawdata)}, memoryview(rawdata))
+    
+    def test_answer_for_revision_since_edited_is_not_shown(self):
+        bridge = ew2vm.Bridge(ew2vm.parse_args(['--vm-input', '1', '--slide-cache-size', '100']))
+        bridge.ew_connected = True
+        self.livedata(bridge, 1, 1)
+        self.livedata(bridge, 2, 2) # slide edited before ew answered
+        bridge.procmsg_ew({'action': 'slideInfo', 'requestrev': 1, 'slide_rowid': 11, 'title': 'Verse 1', 'content': 'old text'}, b'')
+        self.assertFalse(bridge.slides[11].info_received)
+        bridge.procmsg_ew({'action': 'slideInfo', 'requestrev': 1, 'slide_rowid': 11, 'title': 'Verse 1', 'content': 'new text'}, b'')
+        self.assertEqual(bridge.slides[11].info['content'], 'new text')
+        self.assertEqual(bridge.slide_cache.get((100, 11, 1))['content'], 'old text')
+        self.assertEqual(bridge.slide_cache.get((100, 11, 2))['content'], 'new text')
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
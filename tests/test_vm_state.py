@@ -0,0 +1,70 @@
+# test_vm_state.py - when ew2vm reads back what vMix shows
+# https://github.com/mikenor/ew2vm
+#
+# Run from the repository root:
+#
+#     python -m unittest discover tests
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ew2vm
+
+ew2vm.log.level = ew2vm.LOG_QUIET
+
+
+
+
+
+
+class VMStateRequestTest(unittest.TestCase):
+    def connected_bridge(self, *args):
+        bridge = ew2vm.Bridge(ew2vm.parse_args(['--vm-input', '5'] + list(args)))
+        link = bridge.vm_links[0]
+        link.connected = True
+        bridge.vm_connected(link)
+        link.txqueue.popall(0)
+        bridge.procmsg_vm(link, b'XML 7', ew2vm.parse_vm_state(link, b'XML 7', b'<vmix/>'))
+        link.state_received -= 1
+        return bridge, link
+    
+    def test_activity_of_other_inputs_is_ignored(self):
+        bridge, link = self.connected_bridge()
+        bridge.procmsg_vm(link, b'ACTS OK InputPreview 3 1', None)
+        bridge.procmsg_vm(link, b'ACTS OK MasterAudio 1', None)
+        self.assertIsNone(link.state_requested)
+        bridge.procmsg_vm(link, b'ACTS OK Input 5 1', None)
+        self.assertIsNotNone(link.state_requested)
+        self.assertEqual(link.txqueue.popall(0), b'XML\r\n')
+    
+    def test_state_is_read_back_at_most_once_a_second(self):
+        bridge, link = self.connected_bridge()
+        bridge.procmsg_vm(link, b'FUNCTION ER Input not found', None)
+        bridge.procmsg_vm(link, b'XML 7', ew2vm.parse_vm_state(link, b'XML 7', b'<vmix/>'))
+        bridge.procmsg_vm(link, b'FUNCTION ER Input not found', None)
+        self.assertEqual(link.txqueue.popall(0), b'XML\r\n')
+        self.assertTrue(link.state_wanted)
+        
+        # a second later tick asks for it
+        link.state_received -= 1
+        bridge.tick()
+        self.assertFalse(link.state_wanted)
+        self.assertEqual(link.txqueue.popall(0), b'XML\r\n')
+    
+    def test_activity_is_ignored_when_asked_to(self):
+        bridge, link = self.connected_bridge('--vm-ignore-activity')
+        bridge.procmsg_vm(link, b'ACTS OK Input 5 1', None)
+        bridge.procmsg_vm(link, b'FUNCTION ER Input not found', None)
+        self.assertIsNone(link.state_requested)
+        self.assertFalse(link.state_wanted)
+
+
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()